@@ -17,28 +17,40 @@ from debbuilder import Debbuilder
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Response
+from jobs import JobManager
+import events
 import logging
+import metrics
+import os
 import utils
 
 STX_DISTRO = 'bullseye'
 STX_ARCH = 'amd64'
 PKG_BUILDER_LOG = '/localdisk/pkgbuilder.log'
+# 'waitress' serves with the production WSGI server, 'flask' with the
+# Flask development server
+PKGBUILDER_SERVER = os.environ.get('PKGBUILDER_SERVER', 'waitress')
+PKGBUILDER_THREADS = int(os.environ.get('PKGBUILDER_THREADS', 16))
+PKGBUILDER_LOG_LEVEL = os.environ.get('PKGBUILDER_LOG_LEVEL', 'INFO').upper()
+PKGBUILDER_DEBUG = os.environ.get('PKGBUILDER_DEBUG', 'False') == 'True'
 
 app = Flask(__name__)
-app.debug = True
+app.debug = PKGBUILDER_DEBUG
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=PKGBUILDER_LOG_LEVEL)
 log = logging.getLogger('pkgbuilder')
 handler = logging.FileHandler(PKG_BUILDER_LOG, encoding='UTF-8')
 log_format = logging.Formatter("%(asctime)s - %(levelname)s: %(message)s")
 handler.setFormatter(log_format)
 log.addHandler(handler)
 
-app.logger.setLevel(logging.DEBUG)
+app.logger.setLevel(PKGBUILDER_LOG_LEVEL)
 app.logger.addHandler(handler)
 
 utils.set_logger(log)
 dbuilder = Debbuilder('private', STX_DISTRO, STX_ARCH, log)
+job_manager = JobManager(log)
 
 
 def dbuilder_initialized():
@@ -51,20 +63,33 @@ def dbuilder_initialized():
     return True
 
 
-def log_request(action, request):
+def log_request(action, request, level=logging.INFO):
     """
-    Print request with parameters
+    Print request with parameters, the message is only built if
+    the level is enabled
     """
-    msg = 'Received request: ' + request.method + ' ' + action + ': {'
-    for key, value in request.args.items():
-        msg += f"{key}={value}, "
-    msg = msg.rstrip(', ') + '}'
-    log.info(msg)
+    if not log.isEnabledFor(level):
+        return
+    args = ', '.join(f"{key}={value}" for key, value in request.args.items())
+    log.log(level, 'Received request: %s %s: {%s}', request.method, action, args)
+
+
+def run_request(action, func, request):
+    """
+    Run the request inline, or as a background job if it has 'async=True':
+    the response then carries the id to query at /pkgbuilder/jobs/<id>
+    """
+    args = request.args.to_dict()
+    if args.pop('async', None) != 'True':
+        return func(args)
+    job = job_manager.submit(action, func, args)
+    return {'status': 'success', 'msg': 'Job %s submitted' % job.job_id,
+            'job': job.job_id}
 
 
 @app.route('/pkgbuilder/state', methods=['GET'])
 def get_state():
-    log_request('state', request)
+    log_request('state', request, logging.DEBUG)
     init_result = dbuilder_initialized()
     if init_result is not True:
         return jsonify(init_result), 400
@@ -80,6 +105,131 @@ def get_state():
         }), 500
 
 
+@app.route('/pkgbuilder/queue', methods=['GET'])
+def get_queue():
+    log_request('queue', request, logging.DEBUG)
+    init_result = dbuilder_initialized()
+    if init_result is not True:
+        return jsonify(init_result), 400
+
+    try:
+        response = dbuilder.get_queue(request.args)
+        return jsonify(response)
+    except Exception as e:
+        log.error(f"Failed to get queue: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    try:
+        return Response(metrics.registry.exposition(),
+                        mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        log.error(f"Failed to collect metrics: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/pkgbuilder/trace', methods=['GET'])
+def get_trace():
+    log_request('trace', request, logging.DEBUG)
+    init_result = dbuilder_initialized()
+    if init_result is not True:
+        return jsonify(init_result), 400
+
+    try:
+        response = dbuilder.get_trace(request.args)
+        return jsonify(response)
+    except Exception as e:
+        log.error(f"Failed to get trace: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/pkgbuilder/events', methods=['GET'])
+def get_events():
+    log_request('events', request, logging.DEBUG)
+    init_result = dbuilder_initialized()
+    if init_result is not True:
+        return jsonify(init_result), 400
+
+    try:
+        response = dbuilder.get_events(request.args)
+        return jsonify(response)
+    except Exception as e:
+        log.error(f"Failed to get events: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/pkgbuilder/events/stream', methods=['GET'])
+def stream_events():
+    """
+    Server-sent events, each stream holds a server thread until it ends
+    after events.STREAM_DURATION, resumes after 'since' or the
+    Last-Event-ID sent by the reconnecting client
+    """
+    log_request('events/stream', request)
+    try:
+        since = int(request.headers.get('Last-Event-ID', request.args.get('since', 0)))
+        return Response(events.event_bus.stream(since), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    except Exception as e:
+        log.error(f"Failed to stream events: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/pkgbuilder/jobs', methods=['GET'])
+def get_jobs():
+    log_request('jobs', request, logging.DEBUG)
+    try:
+        jobs = job_manager.get_jobs()
+        return jsonify({'status': 'success',
+                        'msg': '%d job(s)' % len(jobs),
+                        'jobs': jobs})
+    except Exception as e:
+        log.error(f"Failed to get jobs: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/pkgbuilder/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    log_request('jobs/' + job_id, request, logging.DEBUG)
+    try:
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({
+                'status': 'fail',
+                'msg': 'No such job: ' + job_id
+            }), 404
+        response = job.to_dict()
+        response['status'] = 'success'
+        response['msg'] = job.state
+        return jsonify(response)
+    except Exception as e:
+        log.error(f"Failed to get job {job_id}: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
 @app.route('/pkgbuilder/loadchroot', methods=['GET'])
 def load_chroot():
     log_request('loadchroot', request)
@@ -88,7 +238,7 @@ def load_chroot():
         return jsonify(init_result), 400
 
     try:
-        response = dbuilder.load_chroot(request.args)
+        response = run_request('loadchroot', dbuilder.load_chroot, request)
         return jsonify(response)
     except Exception as e:
         log.error(f"Failed to load chroot: {e}")
@@ -106,7 +256,7 @@ def clone_chroot():
         return jsonify(init_result), 400
 
     try:
-        response = dbuilder.clone_chroot(request.args)
+        response = run_request('clonechroot', dbuilder.clone_chroot, request)
         return jsonify(response)
     except Exception as e:
         log.error(f"Failed to clone chroot: {e}")
@@ -124,7 +274,7 @@ def save_chroot():
         return jsonify(init_result), 400
 
     try:
-        response = dbuilder.save_chroot(request.args)
+        response = run_request('savechroot', dbuilder.save_chroot, request)
         return jsonify(response)
     except Exception as e:
         log.error(f"Failed to save chroot: {e}")
@@ -142,7 +292,7 @@ def update_parent_chroot():
         return jsonify(init_result), 400
 
     try:
-        response = dbuilder.update_parent_chroot(request.args)
+        response = run_request('updateparentchroot', dbuilder.update_parent_chroot, request)
         return jsonify(response)
     except Exception as e:
         log.error(f"Failed to update parent chroot: {e}")
@@ -160,7 +310,7 @@ def add_chroot():
         return jsonify(init_result), 400
 
     try:
-        response = dbuilder.add_chroot(request.args)
+        response = run_request('addchroot', dbuilder.add_chroot, request)
         return jsonify(response)
     except Exception as e:
         log.error(f"Failed to add chroot: {e}")
@@ -178,7 +328,7 @@ def refresh_chroot():
         return jsonify(init_result), 400
 
     try:
-        response = dbuilder.refresh_chroots(request.args)
+        response = run_request('refreshchroots', dbuilder.refresh_chroots, request)
         return jsonify(response)
     except Exception as e:
         log.error(f"Failed to refresh chroot: {e}")
@@ -243,6 +393,42 @@ def stop_task():
         }), 500
 
 
+@app.route('/pkgbuilder/taskstatus', methods=['GET'])
+def get_task_status():
+    log_request('taskstatus', request, logging.DEBUG)
+    init_result = dbuilder_initialized()
+    if init_result is not True:
+        return jsonify(init_result), 400
+
+    try:
+        response = dbuilder.get_task_status(request.args)
+        return jsonify(response)
+    except Exception as e:
+        log.error(f"Failed to get task status: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
+@app.route('/pkgbuilder/taskresources', methods=['GET'])
+def get_task_resources():
+    log_request('taskresources', request, logging.DEBUG)
+    init_result = dbuilder_initialized()
+    if init_result is not True:
+        return jsonify(init_result), 400
+
+    try:
+        response = dbuilder.get_task_resources(request.args)
+        return jsonify(response)
+    except Exception as e:
+        log.error(f"Failed to get task resources: {e}")
+        return jsonify({
+            'status': 'error',
+            'msg': 'Internal Server Error'
+        }), 500
+
+
 @app.route('/pkgbuilder/cleanstamp', methods=['GET'])
 def clean_stamp():
     log_request('cleanstamp', request)
@@ -279,5 +465,18 @@ def free_tmpfs_chroots():
         }), 500
 
 
+def serve():
+    if PKGBUILDER_SERVER == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            log.warning('waitress is not installed, using the Flask server')
+        else:
+            log.info('Serving with waitress, %d threads', PKGBUILDER_THREADS)
+            waitress.serve(app, host='0.0.0.0', port=80, threads=PKGBUILDER_THREADS)
+            return
+    app.run(host='0.0.0.0', port=80, debug=PKGBUILDER_DEBUG, threaded=True)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=80, debug=True)
+    serve()
@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import json
+import math
+import os
+import threading
+
+# Weight of the latest build in the moving averages
+HISTORY_WEIGHT = 0.5
+# A build which kept busy this share of its CPUs could use more
+SCALING_THRESHOLD = 0.8
+# CPUs given on top of the parallelism a build has shown
+HEADROOM = 1.25
+
+
+def get_source_name(dsc):
+    # e.g. '/path/to/tsconfig_1.0-1.stx.3.dsc' -> 'tsconfig'
+    return os.path.basename(dsc).split('_')[0]
+
+
+class BuildHistory(object):
+    """
+    Duration and CPU usage of the successful builds per source package,
+    kept across restarts, to size the parallelism of the next builds
+    """
+    def __init__(self, history_file, logger):
+        self.history_file = history_file
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.packages = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.history_file) as f:
+                self.packages = json.load(f)
+        except FileNotFoundError:
+            self.packages = {}
+        except (OSError, ValueError) as e:
+            self.logger.warning("Failed to load the build history %s: %s", self.history_file, e)
+            self.packages = {}
+
+    def save(self):
+        tmp_file = self.history_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.packages, f)
+            os.replace(tmp_file, self.history_file)
+        except OSError as e:
+            self.logger.warning("Failed to save the build history %s: %s", self.history_file, e)
+
+    def record(self, package, jobs, elapsed, cpu_seconds):
+        if elapsed <= 0:
+            return
+        parallelism = cpu_seconds / elapsed
+        with self.lock:
+            entry = self.packages.get(package)
+            if entry:
+                entry['builds'] += 1
+                entry['elapsed'] += HISTORY_WEIGHT * (elapsed - entry['elapsed'])
+                entry['cpu_seconds'] += HISTORY_WEIGHT * (cpu_seconds - entry['cpu_seconds'])
+                entry['parallelism'] += HISTORY_WEIGHT * (parallelism - entry['parallelism'])
+                entry['jobs'] = jobs
+            else:
+                self.packages[package] = {'builds': 1, 'jobs': jobs, 'elapsed': elapsed,
+                                          'cpu_seconds': cpu_seconds,
+                                          'parallelism': parallelism}
+            self.save()
+        self.logger.debug("Build history of %s: %d jobs, %.1fs, %.2f CPUs used",
+                          package, jobs, elapsed, parallelism)
+
+    def get(self, package):
+        with self.lock:
+            entry = self.packages.get(package)
+            return dict(entry) if entry else None
+
+    def suggest_jobs(self, package, default_jobs, max_jobs):
+        """
+        The CPUs to give to the next build of the package: twice as many
+        if it used nearly all of them last time, else the parallelism it
+        showed with some headroom
+        """
+        entry = self.get(package)
+        if not entry:
+            return min(default_jobs, max_jobs)
+        if entry['parallelism'] >= entry['jobs'] * SCALING_THRESHOLD:
+            wanted = entry['jobs'] * 2
+        else:
+            wanted = math.ceil(entry['parallelism'] * HEADROOM)
+        return max(1, min(wanted, max_jobs))
@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import os
+import re
+import shlex
+import time
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# Parent of the build cgroups, created next to the cgroup of the
+# service. Set by setup()
+builds_cgroup = None
+CONTROLLERS = ['cpu', 'memory', 'io']
+CPU_PERIOD = 100000
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def write_file(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def read_keyed(path):
+    """Parse the 'key value' lines of a cgroup stat file"""
+    stats = {}
+    for line in read_file(path).splitlines():
+        key, _sep, value = line.partition(' ')
+        if value.isdigit():
+            stats[key] = int(value)
+    return stats
+
+
+def get_own_cgroup():
+    """The cgroup v2 directory of this process, None without cgroup v2"""
+    if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        return None
+    for line in read_file('/proc/self/cgroup').splitlines():
+        if line.startswith('0::'):
+            return os.path.join(CGROUP_ROOT, line[3:].strip().lstrip('/'))
+    return None
+
+
+def setup(logger):
+    """
+    Prepare the parent of the build cgroups, returns the controllers
+    which can be used or None if cgroup v2 is not available
+    """
+    global builds_cgroup
+    own_cgroup = get_own_cgroup()
+    if not own_cgroup:
+        logger.info('cgroup v2 is not available, no per build accounting')
+        return None
+    parent_cgroup = own_cgroup
+    if os.path.basename(own_cgroup) == 'pkgbuilder-service':
+        # Already moved by a previous instance of the service
+        parent_cgroup = os.path.dirname(own_cgroup)
+    service_cgroup = os.path.join(parent_cgroup, 'pkgbuilder-service')
+    try:
+        available = read_file(os.path.join(parent_cgroup, 'cgroup.controllers')).split()
+        enable = ' '.join('+' + c for c in CONTROLLERS if c in available)
+        subtree_control = os.path.join(parent_cgroup, 'cgroup.subtree_control')
+        try:
+            write_file(subtree_control, enable)
+        except OSError:
+            # Only the root cgroup may have both processes and controllers
+            # for its children, move the processes (this service) to a leaf
+            os.makedirs(service_cgroup, exist_ok=True)
+            for pid in read_file(os.path.join(parent_cgroup, 'cgroup.procs')).split():
+                try:
+                    write_file(os.path.join(service_cgroup, 'cgroup.procs'), pid)
+                except OSError:
+                    pass
+            write_file(subtree_control, enable)
+        builds_cgroup = os.path.join(parent_cgroup, 'pkgbuilder-builds')
+        os.makedirs(builds_cgroup, exist_ok=True)
+        write_file(os.path.join(builds_cgroup, 'cgroup.subtree_control'), enable)
+    except OSError as e:
+        logger.warning('Failed to set up the build cgroups: %s', e)
+        builds_cgroup = None
+        return None
+    enabled = read_file(os.path.join(builds_cgroup, 'cgroup.subtree_control')).split()
+    logger.info('Builds are accounted in %s, controllers: %s', builds_cgroup, ' '.join(enabled))
+    return enabled
+
+
+class BuildCgroup(object):
+    """
+    The cgroup of one build: sbuild and all its children run in it,
+    so its stats are the cost of building the package
+    """
+    def __init__(self, name, path=None, started=None):
+        """path and started are given to take over the cgroup of a running build"""
+        self.name = re.sub(r'[^\w.+-]', '_', name)
+        self.path = path or os.path.join(builds_cgroup, '%s-%d' % (self.name, time.time() * 1000))
+        self.started = started or time.time()
+
+    def create(self, cpus=0, memory=0, io_weight=0):
+        """cpus: CPU time limit in CPUs, memory: limit in bytes"""
+        os.makedirs(self.path)
+        if cpus and os.path.exists(os.path.join(self.path, 'cpu.max')):
+            write_file(os.path.join(self.path, 'cpu.max'), '%d %d' % (cpus * CPU_PERIOD, CPU_PERIOD))
+        if memory and os.path.exists(os.path.join(self.path, 'memory.max')):
+            write_file(os.path.join(self.path, 'memory.max'), str(memory))
+        if io_weight and os.path.exists(os.path.join(self.path, 'io.weight')):
+            write_file(os.path.join(self.path, 'io.weight'), 'default %d' % io_weight)
+
+    def wrap_command(self, command):
+        """
+        The shell command which moves itself in the cgroup then runs
+        command, so that no code runs between fork and exec of the
+        multi-threaded service
+        """
+        return 'echo $$ > %s && exec %s' % (
+            shlex.quote(os.path.join(self.path, 'cgroup.procs')), command)
+
+    def get_stats(self):
+        stats = {'cgroup': self.path, 'elapsed': time.time() - self.started}
+        try:
+            cpu_stat = read_keyed(os.path.join(self.path, 'cpu.stat'))
+        except OSError:
+            return stats
+        stats['cpu_seconds'] = cpu_stat.get('usage_usec', 0) / 1000000
+        stats['cpu_user_seconds'] = cpu_stat.get('user_usec', 0) / 1000000
+        stats['cpu_system_seconds'] = cpu_stat.get('system_usec', 0) / 1000000
+        stats['cpu_throttled_seconds'] = cpu_stat.get('throttled_usec', 0) / 1000000
+        for key, filename in (('memory_peak', 'memory.peak'), ('memory_current', 'memory.current')):
+            try:
+                stats[key] = int(read_file(os.path.join(self.path, filename)))
+            except (OSError, ValueError):
+                pass
+        try:
+            stats['oom_kills'] = read_keyed(os.path.join(self.path, 'memory.events')).get('oom_kill', 0)
+        except OSError:
+            pass
+        try:
+            io_stats = {'rbytes': 0, 'wbytes': 0}
+            for line in read_file(os.path.join(self.path, 'io.stat')).splitlines():
+                for field in line.split()[1:]:
+                    key, _sep, value = field.partition('=')
+                    if key in io_stats:
+                        io_stats[key] += int(value)
+            stats['io_read_bytes'] = io_stats['rbytes']
+            stats['io_write_bytes'] = io_stats['wbytes']
+        except OSError:
+            pass
+        return stats
+
+    def remove(self, kill=True, retries=10):
+        """
+        Remove the cgroup, after killing the processes left behind if
+        kill is set, returns True if removed
+        """
+        if kill:
+            try:
+                write_file(os.path.join(self.path, 'cgroup.kill'), '1')
+            except OSError:
+                pass
+        for _retry in range(retries):
+            try:
+                os.rmdir(self.path)
+                return True
+            except FileNotFoundError:
+                return True
+            except OSError:
+                time.sleep(0.1)
+        return False
@@ -0,0 +1,270 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import utils
+
+# Suffix of the side directory which holds the writable layer
+# (upper and work dirs) of an overlay clone
+OVERLAY_SUFFIX = '.overlay'
+# Prefix of the writable layers moved aside by a refresh, pending removal
+DISCARD_PREFIX = 'discard-'
+CLONE_BACKENDS = ['overlay', 'reflink', 'copy']
+
+
+def is_mountpoint(path):
+    return subprocess.run(['mountpoint', '-q', path]).returncode == 0
+
+
+class CopyCloneBackend(object):
+    """
+    Clone the parent chroot with a full copy, this works on any
+    filesystem and is the fallback of the other backends
+    """
+    name = 'copy'
+    cp_opts = '-ar'
+    # Full copies are bound by the disk bandwidth, more parallel
+    # copies only make them seek against each other
+    max_workers = 4
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def create(self, parent_dir, clone_dir, tmpfs_size_gb=0):
+        if tmpfs_size_gb:
+            os.makedirs(clone_dir)
+            shell_cmd = 'mount -t tmpfs -o size=%sG tmpfs %s' % (tmpfs_size_gb, clone_dir)
+            subprocess.check_call(shell_cmd, shell=True)
+            # No block sharing is possible across filesystems
+            shell_cmd = 'cp -ar %s/. %s/' % (parent_dir, clone_dir)
+            subprocess.check_call(shell_cmd, shell=True)
+            return
+        shell_cmd = 'rm -rf %s.tmp' % clone_dir
+        subprocess.check_call(shell_cmd, shell=True)
+        shell_cmd = 'cp %s %s %s.tmp' % (self.cp_opts, parent_dir, clone_dir)
+        subprocess.check_call(shell_cmd, shell=True)
+        shell_cmd = 'mv %s.tmp %s' % (clone_dir, clone_dir)
+        subprocess.check_call(shell_cmd, shell=True)
+
+    def refresh(self, parent_dir, clone_dir, tmpfs=False):
+        if tmpfs:
+            utils.clear_directory(clone_dir)
+            subprocess.check_call('cp -ar %s/. %s/' % (parent_dir, clone_dir), shell=True)
+            return
+        clone_tmp_path = clone_dir + '.tmp'
+        clone_old_path = clone_dir + '.tmp.old'
+        subprocess.check_call('cp %s %s %s' % (self.cp_opts, parent_dir, clone_tmp_path),
+                              shell=True)
+        # Atomic swap via renames
+        if os.path.exists(clone_dir):
+            os.rename(clone_dir, clone_old_path)
+        os.rename(clone_tmp_path, clone_dir)
+        # Non-critical cleanup of old version
+        subprocess.run('rm -rf --one-file-system ' + clone_old_path,
+                       shell=True, check=False)
+
+    def remove(self, clone_dir):
+        if utils.is_tmpfs(clone_dir):
+            utils.unmount_tmpfs(clone_dir)
+        if os.path.exists(clone_dir):
+            shell_cmd = 'rm -rf --one-file-system %s' % clone_dir
+            self.logger.debug('shell_cmd=%s', shell_cmd)
+            subprocess.check_call(shell_cmd, shell=True)
+
+
+class ReflinkCloneBackend(CopyCloneBackend):
+    """
+    Clone the parent chroot with copy-on-write extents (btrfs, xfs),
+    the data blocks are shared until either side writes them
+    """
+    name = 'reflink'
+    cp_opts = '-a --reflink=always'
+    # Only metadata is written
+    max_workers = 8
+
+
+class OverlayCloneBackend(CopyCloneBackend):
+    """
+    Mount the clone as an overlay with the parent chroot as the read-only
+    lower dir, only the files written by the build take space in the
+    upper dir. For tmpfs clones the upper dir lives on a tmpfs.
+
+    The parent chroot must never be modified in place while overlay
+    clones are mounted on it, it is replaced with copy-then-swap instead.
+    """
+    name = 'overlay'
+    # Creating a clone is a few mounts
+    max_workers = 16
+
+    def get_layer_dir(self, clone_dir):
+        return clone_dir + OVERLAY_SUFFIX
+
+    def mount(self, parent_dir, clone_dir):
+        layer_dir = self.get_layer_dir(clone_dir)
+        upper_dir = os.path.join(layer_dir, 'upper')
+        work_dir = os.path.join(layer_dir, 'work')
+        os.makedirs(upper_dir, exist_ok=True)
+        os.makedirs(work_dir, exist_ok=True)
+        os.makedirs(clone_dir, exist_ok=True)
+        shell_cmd = 'mount -t overlay overlay -o lowerdir=%s,upperdir=%s,workdir=%s %s' % (
+                    parent_dir, upper_dir, work_dir, clone_dir)
+        self.logger.debug('shell_cmd=%s', shell_cmd)
+        subprocess.check_call(shell_cmd, shell=True)
+
+    def create(self, parent_dir, clone_dir, tmpfs_size_gb=0):
+        layer_dir = self.get_layer_dir(clone_dir)
+        os.makedirs(layer_dir, exist_ok=True)
+        if tmpfs_size_gb:
+            shell_cmd = 'mount -t tmpfs -o size=%sG tmpfs %s' % (tmpfs_size_gb, layer_dir)
+            subprocess.check_call(shell_cmd, shell=True)
+        self.mount(parent_dir, clone_dir)
+
+    def refresh(self, parent_dir, clone_dir, tmpfs=False):
+        '''
+        Throw away only the writable layer of the clone: a tmpfs layer is
+        remounted empty, a layer on disk is moved aside and deleted in the
+        background. The parent (lower dir) is never copied.
+        '''
+        layer_dir = self.get_layer_dir(clone_dir)
+        if os.path.exists(clone_dir) and is_mountpoint(clone_dir):
+            subprocess.check_call('umount %s' % clone_dir, shell=True)
+        if is_mountpoint(layer_dir):
+            statvfs = os.statvfs(layer_dir)
+            tmpfs_size = statvfs.f_frsize * statvfs.f_blocks
+            subprocess.check_call('umount %s' % layer_dir, shell=True)
+            shell_cmd = 'mount -t tmpfs -o size=%s tmpfs %s' % (tmpfs_size, layer_dir)
+            subprocess.check_call(shell_cmd, shell=True)
+        elif os.path.isdir(layer_dir):
+            discard_dir = tempfile.mkdtemp(prefix=DISCARD_PREFIX, dir=layer_dir)
+            for name in ('upper', 'work'):
+                path = os.path.join(layer_dir, name)
+                if os.path.exists(path):
+                    os.rename(path, os.path.join(discard_dir, name))
+            self.discard_layers(layer_dir)
+        self.mount(parent_dir, clone_dir)
+
+    def discard_layers(self, layer_dir):
+        '''Delete the discarded writable layers off the refresh path.'''
+        paths = [os.path.join(layer_dir, name) for name in os.listdir(layer_dir)
+                 if name.startswith(DISCARD_PREFIX)]
+        if not paths:
+            return
+        shell_cmd = 'rm -rf --one-file-system %s' % ' '.join(paths)
+        self.logger.debug('shell_cmd=%s', shell_cmd)
+        threading.Thread(target=subprocess.run, args=(shell_cmd,),
+                         kwargs={'shell': True, 'check': False},
+                         daemon=True).start()
+
+    def remove(self, clone_dir):
+        layer_dir = self.get_layer_dir(clone_dir)
+        for mnt in (clone_dir, layer_dir):
+            if os.path.exists(mnt) and is_mountpoint(mnt):
+                subprocess.check_call('umount %s' % mnt, shell=True)
+        for path in (clone_dir, layer_dir):
+            if os.path.exists(path):
+                shell_cmd = 'rm -rf --one-file-system %s' % path
+                self.logger.debug('shell_cmd=%s', shell_cmd)
+                subprocess.check_call(shell_cmd, shell=True)
+
+
+BACKEND_CLASSES = {
+    'overlay': OverlayCloneBackend,
+    'reflink': ReflinkCloneBackend,
+    'copy': CopyCloneBackend,
+}
+
+
+def probe_overlay(probe_dir):
+    lower_dir = os.path.join(probe_dir, 'lower')
+    upper_dir = os.path.join(probe_dir, 'upper')
+    work_dir = os.path.join(probe_dir, 'work')
+    merged_dir = os.path.join(probe_dir, 'merged')
+    for path in (lower_dir, upper_dir, work_dir, merged_dir):
+        os.makedirs(path)
+    ret = subprocess.run(['mount', '-t', 'overlay', 'overlay', '-o',
+                          'lowerdir=%s,upperdir=%s,workdir=%s' % (lower_dir, upper_dir, work_dir),
+                          merged_dir], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if ret.returncode != 0:
+        return False
+    subprocess.run(['umount', merged_dir], check=False)
+    return True
+
+
+def probe_reflink(probe_dir):
+    src = os.path.join(probe_dir, 'reflink.src')
+    with open(src, 'w') as f:
+        f.write('reflink probe')
+    ret = subprocess.run(['cp', '--reflink=always', src, src + '.dst'],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return ret.returncode == 0
+
+
+def supports_reflink(directory):
+    """Whether the files in directory can be copied with shared extents"""
+    try:
+        probe_dir = tempfile.mkdtemp(prefix='.clone-probe-', dir=directory)
+    except OSError:
+        return False
+    try:
+        return probe_reflink(probe_dir)
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+
+
+def detect_clone_backend(chroots_dir, logger):
+    """
+    Find the cheapest clone method supported where the chroots are stored:
+    overlay, then reflink, then the plain copy
+    """
+    try:
+        probe_dir = tempfile.mkdtemp(prefix='.clone-probe-', dir=chroots_dir)
+    except OSError as e:
+        logger.warning('Failed to create clone probe directory in %s: %s', chroots_dir, e)
+        return CopyCloneBackend(logger)
+    try:
+        if probe_overlay(probe_dir):
+            return OverlayCloneBackend(logger)
+        if probe_reflink(probe_dir):
+            return ReflinkCloneBackend(logger)
+    except Exception as e:
+        logger.warning('Failed to probe clone backends in %s: %s', chroots_dir, e)
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+    return CopyCloneBackend(logger)
+
+
+def get_clone_backend(name, chroots_dir, logger):
+    if name in BACKEND_CLASSES:
+        return BACKEND_CLASSES[name](logger)
+    backend = detect_clone_backend(chroots_dir, logger)
+    logger.info('Detected clone backend for %s: %s', chroots_dir, backend.name)
+    return backend
+
+
+def get_clone_backend_of(clone_dir, default_backend, logger):
+    """
+    The backend which created an existing clone: overlay clones are
+    recognized by their layer directory, the others are plain directories
+    """
+    if os.path.isdir(clone_dir + OVERLAY_SUFFIX):
+        if isinstance(default_backend, OverlayCloneBackend):
+            return default_backend
+        return OverlayCloneBackend(logger)
+    if isinstance(default_backend, OverlayCloneBackend):
+        return CopyCloneBackend(logger)
+    return default_backend
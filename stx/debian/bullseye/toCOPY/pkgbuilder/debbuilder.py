@@ -12,15 +12,28 @@
 #
 # Copyright (C) 2021-2022 Wind River Systems,Inc
 #
+import cgroups
+import buildhistory
+import chrootclone
+import collections
+import concurrent.futures
+import dpkgstatus
+import events
 import fs
+import jobs as jobmanager
+import metrics
 import os
+import poolstate
 import psutil
 import schrootspool
 import shutil
 import signal
+import stat
 import subprocess
+import tempfile
 import threading
 import time
+import tracing
 import utils
 
 BUILD_ROOT = '/localdisk/loadbuild/'
@@ -33,6 +46,29 @@ ENVIRON_VARS = ['OSTREE_OSNAME', 'OS_MIRROR_URL', 'OS_MIRROR_DIST_PATH',
                 'PLATFORM_REGISTRY', 'BUILD_STREAM', 'IMAGE_PREFIX',
                 'IMAGE_SUFFIX', 'OS', 'OS_CODENAME', 'OS_ARCH']
 REPO_BUILD = 'deb-local-build'
+# Seconds the parent chroot update requests are collected before
+# being applied as one upgrade
+PARENT_UPDATE_WINDOW = 10
+# Seconds a request waits for the batched upgrade run by another request,
+# it holds a server thread meanwhile
+PARENT_UPDATE_WAIT = 600
+# Seconds to wait for the parent chroot lock before giving up
+PARENT_LOCK_TIMEOUT = 1800
+# Seconds the upgrade of the staging parent chroot may take
+PARENT_UPGRADE_TIMEOUT = 300
+# Seconds between two checks of the sbuild processes by the reaper
+REAP_INTERVAL = 2
+# Exit status of the finished builds kept for the queries
+MAX_TASK_RESULTS = 1024
+# Seconds a killed build has to clean up before its cgroup is killed
+CGROUP_KILL_GRACE = 60
+# Parallel jobs of a package without build history
+DEFAULT_JOBS = 4
+# CPUs shared by the parallel jobs of all the running builds
+CORE_BUDGET = int(os.environ.get('PKGBUILDER_CORE_BUDGET', os.cpu_count() or DEFAULT_JOBS))
+BUILD_HISTORY = os.path.join(STORE_ROOT, 'build-history.json')
+# State of the pool and the running builds, kept across restarts
+POOL_STATE = os.path.join(STORE_ROOT, 'pool-state.json')
 
 
 def check_request(request_form, needed_form):
@@ -45,29 +81,116 @@ def check_request(request_form, needed_form):
 
 
 class _ParentChrootLock(object):
-    """Read-write lock: multiple clones (readers) OR one parent update (writer)."""
+    """
+    Read-write lock: multiple clones (readers) OR one parent update (writer).
+
+    Writers are preferred: new readers wait while a writer is waiting, so a
+    stream of refreshes can not starve a parent update. The readers already
+    waiting when a writer releases go first, before the next writer.
+    """
     def __init__(self):
-        self._read_lock = threading.Lock()
-        self._write_lock = threading.Lock()
+        self._cond = threading.Condition(threading.Lock())
         self._readers = 0
-
-    def acquire_read(self):
-        with self._read_lock:
-            self._readers += 1
-            if self._readers == 1:
-                self._write_lock.acquire()
+        self._writer = False
+        self._readers_waiting = 0
+        self._writers_waiting = 0
+        self._readers_turn = False
+        self._stats = {'read': self._new_stats(), 'write': self._new_stats()}
+        # Acquire times for the hold time metrics, readers release the
+        # lock in the thread which acquired it
+        self._local = threading.local()
+        self._write_start = 0
+
+    def _new_stats(self):
+        return {'acquired': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+    def _account(self, mode, start_time, acquired):
+        stats = self._stats[mode]
+        wait_time = time.time() - start_time
+        metrics.PARENT_LOCK_WAIT_SECONDS.observe(wait_time, mode=mode)
+        stats['wait_total'] += wait_time
+        stats['wait_max'] = max(stats['wait_max'], wait_time)
+        if acquired:
+            stats['acquired'] += 1
+        else:
+            stats['timeouts'] += 1
+
+    def acquire_read(self, timeout=None):
+        start_time = time.time()
+        with self._cond:
+            self._readers_waiting += 1
+            acquired = self._cond.wait_for(
+                lambda: not self._writer and (self._readers_turn or not self._writers_waiting),
+                timeout)
+            self._readers_waiting -= 1
+            if not self._readers_waiting:
+                self._readers_turn = False
+            if acquired:
+                self._readers += 1
+                self._local.read_start = time.time()
+            else:
+                # A waiting writer may have been held back by this reader's turn
+                self._cond.notify_all()
+            self._account('read', start_time, acquired)
+        return acquired
 
     def release_read(self):
-        with self._read_lock:
+        metrics.PARENT_LOCK_HOLD_SECONDS.observe(time.time() - self._local.read_start, mode='read')
+        with self._cond:
             self._readers -= 1
             if self._readers == 0:
-                self._write_lock.release()
-
-    def acquire_write(self):
-        self._write_lock.acquire()
+                self._cond.notify_all()
+
+    def acquire_write(self, timeout=None):
+        start_time = time.time()
+        with self._cond:
+            self._writers_waiting += 1
+            acquired = self._cond.wait_for(
+                lambda: not self._writer and not self._readers and not self._readers_turn,
+                timeout)
+            self._writers_waiting -= 1
+            if acquired:
+                self._writer = True
+                self._write_start = time.time()
+            else:
+                self._cond.notify_all()
+            self._account('write', start_time, acquired)
+        return acquired
 
     def release_write(self):
-        self._write_lock.release()
+        metrics.PARENT_LOCK_HOLD_SECONDS.observe(time.time() - self._write_start, mode='write')
+        with self._cond:
+            self._writer = False
+            self._readers_turn = self._readers_waiting > 0
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            stats = {'readers': self._readers,
+                     'writer': self._writer,
+                     'readers_waiting': self._readers_waiting,
+                     'writers_waiting': self._writers_waiting}
+            for mode, mode_stats in self._stats.items():
+                waits = mode_stats['acquired'] + mode_stats['timeouts']
+                stats[mode] = dict(mode_stats)
+                stats[mode]['wait_avg'] = mode_stats['wait_total'] / waits if waits else 0.0
+        return stats
+
+
+class _ParentUpdateBatch(object):
+    """Parent chroot update requests collected for one batched upgrade."""
+    def __init__(self):
+        self.generations = []
+        self.packages = set()
+        self.debs = []
+        self.flush = threading.Event()
+        self.done = threading.Event()
+        self.response = None
+
+    def add(self, generation, packages, debs):
+        self.generations.append(generation)
+        self.packages |= packages
+        self.debs.extend(deb for deb in debs if deb not in self.debs)
 
 
 class Debbuilder(object):
@@ -102,12 +225,68 @@ class Debbuilder(object):
         self.attrs['dist'] = dist
         self.attrs['arch'] = arch
         self.attrs['unique_id'] = None
+        # Exported variables of stx-localrc, parsed again when its mtime
+        # changes, and the extra repository URLs by (snapshot_idx, repo)
+        self.localrc_lock = threading.Lock()
+        self.localrc_mtime = None
+        self.localrc_vars = {}
+        self.extra_repo_urls = {}
         self.set_extra_repos()
         self.set_environ_vars()
         os.system('/opt/setup.sh')
         self.schroot_config_dir = '/etc/schroot/chroot.d'
         self._parent_lock = _ParentChrootLock()
-        self._parent_installed_pkgs = set()  # populated after chroot creation
+        # Bumped under the write lock when the parent chroot changes, a
+        # refresh from an older parent does not make a chroot clean
+        self.parent_version = 0
+        # Old parents kept for the overlay clones still mounted on them:
+        # retired dir -> (retire time, names of the clones)
+        self.retired_parents = {}
+        self.retired_parents_lock = threading.Lock()
+        self._parent_update_lock = threading.Lock()
+        # Pending parent update batch per (user, project), the generation
+        # numbers the update requests in their order of arrival
+        self._parent_update_batches = {}
+        self._parent_update_generation = 0
+        self._parent_batches_lock = threading.Lock()
+        self._parent_dpkg_status = dpkgstatus.DpkgStatusIndex(logger)  # loaded after chroot creation
+        self.clone_backend = None  # detected on first clone/refresh
+        # (user, project) of the chroots in the pool, for background refreshes
+        self.pool_owner = None
+        self.refresh_event = threading.Event()
+        # Held by the refresher while it refreshes a chroot, and while the
+        # clones are deleted or created
+        self.refresh_lock = threading.Lock()
+        self.refresher = threading.Thread(target=self.refresh_dirty_chroots,
+                                          name='chroot-refresher', daemon=True)
+        self.refresher.start()
+        # Exit status of the finished builds by dsc, sbuild_processes and
+        # chroots_state are shared with the reaper under tasks_lock
+        self.task_results = collections.OrderedDict()
+        self.tasks_lock = threading.Lock()
+        # Each build runs in its own cgroup, its resource usage is kept by dsc
+        self.cgroup_controllers = cgroups.setup(logger)
+        self.task_cgroups = {}
+        # (cgroup, finish time) of the killed builds still cleaning up
+        self.stale_cgroups = []
+        # Parallel jobs of the running builds by dsc, within CORE_BUDGET
+        self.task_jobs = {}
+        self.task_start_times = {}
+        # Process creation times, to tell the builds from reused pids
+        self.task_create_times = {}
+        metrics.registry.gauge('pkgbuilder_jobs_allocated',
+                               'Parallel jobs of the running builds', ['budget'],
+                               lambda: {(str(CORE_BUDGET),): sum(self.task_jobs.values())})
+        self.build_history = buildhistory.BuildHistory(BUILD_HISTORY, logger)
+        self.task_resources = collections.OrderedDict()
+        # The state of the pool and the builds is saved on every change and
+        # taken over after a restart
+        self.pool_state = poolstate.PoolState(POOL_STATE, logger)
+        self.chroots_pool.on_change = self.pool_state.set_chroots
+        self.reconcile_pool_state()
+        self.reaper = threading.Thread(target=self.reap_sbuild_processes,
+                                       name='sbuild-reaper', daemon=True)
+        self.reaper.start()
         self.logger.debug("Debbuilder initalized for dist %s", self.attrs['dist'])
 
     def get_parent_chroot_name(self, user):
@@ -145,6 +324,18 @@ class Debbuilder(object):
         user_dir = self.get_user_dir(user, project)
         return os.path.join(user_dir, build_type, 'stamp')
 
+    def get_clone_backend(self, user, project, clone_chroot_dir=None):
+        '''
+        The backend used to clone chroots in the user's chroots directory,
+        or the one which created clone_chroot_dir if it is given
+        '''
+        if self.clone_backend is None:
+            user_chroots_dir = self.get_user_chroots_dir(user, project)
+            self.clone_backend = chrootclone.get_clone_backend('auto', user_chroots_dir, self.logger)
+        if clone_chroot_dir is None:
+            return self.clone_backend
+        return chrootclone.get_clone_backend_of(clone_chroot_dir, self.clone_backend, self.logger)
+
     def compose_chroot_name(self, user, index=None):
         chroot_name = '-'.join([self.attrs['dist'], self.attrs['arch'], user])
         if index is not None:
@@ -226,6 +417,14 @@ class Debbuilder(object):
         response = {}
         response['status'] = 'success'
         response['msg'] = self.attrs['state']
+        response['parent_lock'] = self._parent_lock.get_stats()
+        return response
+
+    def get_queue(self, request_form):
+        response = {}
+        response['status'] = 'success'
+        response['queue'] = self.chroots_pool.get_queue()
+        response['msg'] = '%d task(s) waiting for a chroot' % len(response['queue'])
         return response
 
     def set_environ_vars(self):
@@ -255,22 +454,42 @@ class Debbuilder(object):
                 ret = os.system(replace_cmd)
                 self.logger.debug('The return value of macro replacing is %d', ret)
 
+    def get_localrc_vars(self):
+        '''
+        The variables exported by stx-localrc, None if it does not exist.
+        The file is only parsed again after it changed
+        '''
+        try:
+            mtime = os.stat(STX_LOCALRC).st_mtime_ns
+        except OSError:
+            with self.localrc_lock:
+                self.localrc_mtime = None
+                self.localrc_vars = {}
+                self.extra_repo_urls = {}
+            return None
+
+        with self.localrc_lock:
+            if mtime != self.localrc_mtime:
+                env_vars = {}
+                with open(STX_LOCALRC) as f:
+                    for item in f:
+                        if item.startswith('export '):
+                            envvar = item.replace('export ', '').split('=')
+                            if envvar and len(envvar) >= 2:
+                                env_vars.setdefault(envvar[0].strip(), envvar[1].strip())
+                self.logger.debug("Loaded %d variables from %s", len(env_vars), STX_LOCALRC)
+                self.localrc_mtime = mtime
+                self.localrc_vars = env_vars
+                self.extra_repo_urls = {}
+            return self.localrc_vars
+
     def set_extra_repos(self):
-        repomgr_url = None
-        if not os.path.exists(STX_LOCALRC):
+        env_vars = self.get_localrc_vars()
+        if env_vars is None:
             self.logger.warning('stx-localrc does not exist')
             return
 
-        env_list = []
-        with open(STX_LOCALRC) as f:
-            env_list = list(f)
-        for item in env_list:
-            if item.startswith('export '):
-                envvar = item.replace('export ', '').split('=')
-                if envvar and len(envvar) >= 2 and envvar[0].strip() == 'REPOMGR_DEPLOY_URL':
-                    repomgr_url = envvar[1].strip()
-                    break
-
+        repomgr_url = env_vars.get('REPOMGR_DEPLOY_URL')
         if repomgr_url:
             url_parts = repomgr_url.split(':')
             repo_origin = url_parts[1][2:]
@@ -287,12 +506,9 @@ class Debbuilder(object):
                 self.logger.error(str(e))
 
     def has_chroot(self, chroot):
-        chroots = os.popen('schroot --list')
-        target_line = "chroot:" + chroot
-        for line in chroots:
-            if line.strip() == target_line:
-                self.logger.info("chroot %s exists" % chroot)
-                return True
+        if schrootspool.schroot_config_index.get(chroot):
+            self.logger.info("chroot %s exists" % chroot)
+            return True
         return False
 
     def is_parent_config(self, schroot_config_name, user):
@@ -319,38 +535,290 @@ class Debbuilder(object):
         else:
             self.logger.error("failed to determine schroot unique_id from parent schroot name")
 
-    def get_chroot_sessions(self, chroot_name):
-        sessions = subprocess.run(['schroot', '--list', '--all-sessions'],
-                                  stdout=subprocess.PIPE,
-                                  universal_newlines=True).stdout.splitlines()
-        self.logger.debug('Found %d total schroot session(s)', len(sessions))
-        for session in sessions:
-            # Pre-filter: skip sessions that can't possibly match.
-            # The authoritative check is original-name= from schroot
-            # --config below, but this avoids unnecessary subprocess calls.
-            if not session.startswith('session:%s-' % chroot_name):
+    def set_pool_owner(self, user, project):
+        self.pool_owner = (user, project)
+        self.pool_state.set_owner(self.pool_owner)
+
+    def load_pool(self, user, project, dirty=True):
+        '''
+        Load the chroots into the pool, the chroots of the same user and
+        project keep their saved state: busy, clean or dirty
+        '''
+        state = self.pool_state.get()
+        saved_states = None
+        if state['owner'] == [user, project]:
+            saved_states = state['chroots']
+        return self.chroots_pool.load(dirty=dirty, saved_states=saved_states)
+
+    def save_tasks(self):
+        '''Save the running builds, for a restarted service to take them over'''
+        tasks = {}
+        with self.tasks_lock:
+            for user, processes in self.sbuild_processes.items():
+                for dsc, p in processes.items():
+                    cgroup = self.task_cgroups.get(dsc)
+                    tasks[dsc] = {'user': user, 'chroot': self.chroots_state.get(dsc),
+                                  'pid': p.pid, 'create_time': self.task_create_times.get(dsc),
+                                  'start_time': self.task_start_times.get(dsc),
+                                  'jobs': self.task_jobs.get(dsc),
+                                  'cgroup': cgroup.path if cgroup else None}
+        self.pool_state.set_tasks(tasks)
+
+    def reconcile_pool_state(self):
+        '''
+        Take over from the previous instance of the service: its builds
+        are adopted, the reaper finishes the ones which are not running
+        any more, and the pool is loaded back with the saved states if
+        its chroots are configured
+        '''
+        state = self.pool_state.get()
+        for dsc, task in state['tasks'].items():
+            if not task['create_time']:
+                self.logger.warning("Can not take over the build of %s, pid %d", dsc, task['pid'])
                 continue
-            session_matches = False
-            mount_location = None
-            config = subprocess.run(
-                ['schroot', '--config', '--chroot', session],
-                stdout=subprocess.PIPE,
-                universal_newlines=True).stdout.splitlines()
-            for line in config:
-                line = line.strip()
-                if line == 'original-name=%s' % chroot_name:
-                    session_matches = True
-                elif line.startswith('mount-location='):
-                    mount_location = line.split('=', 1)[1].strip()
-            if session_matches:
-                yield (session, mount_location)
+            # sbuild writes e.g. 'tsconfig_1.0-1.stx.3_amd64.build' next to the dsc
+            build_log = '%s_%s.build' % (os.path.splitext(dsc)[0], self.attrs['arch'])
+            p = poolstate.AdoptedProcess(task['pid'], task['create_time'], build_log)
+            self.logger.info("Taking over the build of %s in %s, pid %d, running: %s",
+                             dsc, task['chroot'], p.pid, p.is_alive())
+            self.sbuild_processes.setdefault(task['user'], {})[dsc] = p
+            self.chroots_state[dsc] = task['chroot']
+            self.task_create_times[dsc] = task['create_time']
+            if task['start_time']:
+                self.task_start_times[dsc] = task['start_time']
+            if task['jobs']:
+                self.task_jobs[dsc] = task['jobs']
+            if task['cgroup'] and os.path.isdir(task['cgroup']):
+                self.task_cgroups[dsc] = cgroups.BuildCgroup(os.path.basename(dsc), task['cgroup'],
+                                                             task['start_time'])
+            events.publish('task_adopted', dsc=dsc, chroot=task['chroot'], pid=p.pid)
+        self.save_tasks()
+
+        # Only the chroots of the adopted builds are still busy
+        busy = set(self.chroots_state.values())
+        chroots = {}
+        for name, saved in state['chroots'].items():
+            if saved['state'] != 'idle' and name not in busy:
+                saved = dict(saved, state='idle', dirty=True)
+            chroots[name] = saved
+        self.pool_state.set_chroots(chroots)
+
+        if state['owner']:
+            user, project = state['owner']
+            self.pool_owner = (user, project)
+            if self.chroots_pool.get_schroot_clone_list():
+                self.load_pool(user, project)
+                self.chroots_pool.show()
+                self.refresh_event.set()
+
+    def refresh_dirty_chroots(self):
+        '''
+        Background refresher: refresh the idle chroots released by builds
+        so that add_task gets clean chroots and does not wait for a refresh
+        '''
+        while True:
+            self.refresh_event.wait()
+            self.refresh_event.clear()
+            failed = set()
+            while True:
+                with self.refresh_lock:
+                    if self.pool_owner is None:
+                        break
+                    user, project = self.pool_owner
+                    chroot = self.chroots_pool.claim_dirty(exclude=failed)
+                    if not chroot:
+                        break
+                    try:
+                        refresh_result = self.refresh_single_chroot(user, project, chroot)
+                    except Exception as e:
+                        self.logger.error("Background refresh of %s failed: %s", chroot, e)
+                        refresh_result = {'status': 'fail'}
+                    if refresh_result['status'] != 'success':
+                        failed.add(chroot)
+                    self.chroots_pool.finish_refresh(chroot, self._is_refreshed(refresh_result))
+
+    def reap_sbuild_processes(self):
+        '''
+        Reaper: record the exit status of the finished builds and give
+        their chroots back to the pool, even if the client never kills
+        the task
+        '''
+        while True:
+            time.sleep(REAP_INTERVAL)
+            reaped = []
+            with self.tasks_lock:
+                for processes in self.sbuild_processes.values():
+                    for dsc, p in list(processes.items()):
+                        if p.poll() is not None:
+                            del processes[dsc]
+                            reaped.append((dsc, p))
+            for dsc, p in reaped:
+                self.logger.info("Build of %s exited with %d", dsc, p.returncode)
+                self._finish_task(dsc, p, 'exited')
+            if reaped:
+                self.refresh_event.set()
+            self._remove_stale_cgroups()
+
+    def _remove_stale_cgroups(self):
+        with self.tasks_lock:
+            stale_cgroups, self.stale_cgroups = self.stale_cgroups, []
+        remaining = []
+        for cgroup, finished in stale_cgroups:
+            kill = time.time() - finished > CGROUP_KILL_GRACE
+            if not cgroup.remove(kill=kill, retries=1):
+                if kill:
+                    self.logger.debug("Failed to remove the cgroup %s", cgroup.path)
+                remaining.append((cgroup, finished))
+        with self.tasks_lock:
+            self.stale_cgroups.extend(remaining)
+
+    def _finish_task(self, dsc, p, state):
+        '''Record the exit status of the build and give its chroot back to the pool'''
+        with self.tasks_lock:
+            chroot = self.chroots_state.pop(dsc, None)
+            cgroup = self.task_cgroups.pop(dsc, None)
+            jobs = self.task_jobs.pop(dsc, None)
+            start_time = self.task_start_times.pop(dsc, None)
+            self.task_create_times.pop(dsc, None)
+        self.save_tasks()
+        resources = None
+        if cgroup:
+            resources = cgroup.get_stats()
+            # A killed sbuild still ends its schroot session, its cgroup is
+            # removed later by the reaper
+            if not cgroup.remove(kill=(state == 'exited'), retries=1):
+                with self.tasks_lock:
+                    self.stale_cgroups.append((cgroup, time.time()))
+        with self.tasks_lock:
+            # The return code is None if the build is still running and is killed
+            result = {'dsc': dsc, 'chroot': chroot, 'pid': p.pid, 'returncode': p.poll(),
+                      'state': state, 'finished': time.time()}
+            if start_time:
+                metrics.SBUILD_SECONDS.observe(
+                    result['finished'] - start_time, state=state,
+                    result={None: 'none', 0: 'success'}.get(result['returncode'], 'fail'))
+            self.task_results.pop(dsc, None)
+            self.task_results[dsc] = result
+            while len(self.task_results) > MAX_TASK_RESULTS:
+                self.task_results.popitem(last=False)
+            if resources:
+                self.task_resources.pop(dsc, None)
+                self.task_resources[dsc] = resources
+                while len(self.task_resources) > MAX_TASK_RESULTS:
+                    self.task_resources.popitem(last=False)
+        if resources:
+            self.logger.info("Build of %s used %.1f CPU seconds, %s peak memory in %.1fs",
+                             dsc, resources.get('cpu_seconds', 0),
+                             resources.get('memory_peak', 'unknown'), resources['elapsed'])
+            if state == 'exited' and p.returncode == 0 and jobs and 'cpu_seconds' in resources:
+                self.build_history.record(buildhistory.get_source_name(dsc), jobs,
+                                          resources['elapsed'], resources['cpu_seconds'])
+        if chroot:
+            self.chroots_pool.release(chroot)
+            self.logger.debug('The chroot %s for %s is released', chroot, dsc)
+        events.publish('task_finished', **result)
+
+    def allocate_jobs(self, dsc, jobs=0):
+        '''
+        The parallel jobs of the build: as requested if 'jobs' is set, else
+        sized by the build history of the package within the cores left
+        by the running builds
+        '''
+        if not jobs:
+            package = buildhistory.get_source_name(dsc)
+            wanted = self.build_history.suggest_jobs(package, DEFAULT_JOBS, CORE_BUDGET)
+        with self.tasks_lock:
+            if not jobs:
+                free = CORE_BUDGET - sum(njobs for key, njobs in self.task_jobs.items() if key != dsc)
+                jobs = max(1, min(wanted, free))
+                self.logger.debug("%s gets %d jobs, wanted %d, %d cores free",
+                                  package, jobs, wanted, free)
+            self.task_jobs[dsc] = jobs
+        return jobs
+
+    def _abort_task(self, dsc, chroot, cgroup):
+        '''Undo add_task for a build which could not be started'''
+        with self.tasks_lock:
+            if self.chroots_state.get(dsc) == chroot:
+                del self.chroots_state[dsc]
+            self.task_jobs.pop(dsc, None)
+        if cgroup:
+            cgroup.remove()
+        self.chroots_pool.release(chroot)
+
+    def _kill_build(self, p):
+        # sbuild runs in its own process group, led by the shell
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def get_task_status(self, request_form):
+        response = check_request(request_form, ['dsc'])
+        if response:
+            return response
+        dsc = request_form['dsc']
+        with self.tasks_lock:
+            for processes in self.sbuild_processes.values():
+                if dsc in processes:
+                    task = {'dsc': dsc, 'chroot': self.chroots_state.get(dsc),
+                            'pid': processes[dsc].pid, 'returncode': None,
+                            'state': 'running'}
+                    break
+            else:
+                task = self.task_results.get(dsc)
+        if not task:
+            response['status'] = 'fail'
+            response['msg'] = 'No such task: ' + dsc
+            return response
+        response['status'] = 'success'
+        response['msg'] = task['state']
+        response['task'] = task
+        return response
 
+    def get_task_resources(self, request_form):
+        '''
+        CPU, memory and IO used by the builds: live for the running ones,
+        final for the finished ones. All builds if no 'dsc' is given
+        '''
+        response = {}
+        with self.tasks_lock:
+            running = dict(self.task_cgroups)
+            finished = dict(self.task_resources)
+        resources = {dsc: cgroup.get_stats() for dsc, cgroup in running.items()}
+        for dsc, stats in finished.items():
+            resources.setdefault(dsc, stats)
+        if 'dsc' in request_form:
+            dsc = request_form['dsc']
+            if dsc not in resources:
+                response['status'] = 'fail'
+                response['msg'] = 'No resource usage recorded for ' + dsc
+                return response
+            resources = {dsc: resources[dsc]}
+        response['status'] = 'success'
+        response['msg'] = '%d running, %d finished' % (len(running), len(finished))
+        response['resources'] = resources
+        return response
+
+    def get_all_chroot_sessions(self):
+        '''All schroot sessions grouped by the name of their chroot.'''
+        chroot_sessions = {}
+        sessions = schrootspool.get_schroot_sessions()
+        self.logger.debug('Found %d total schroot session(s)', len(sessions))
+        for session, original_name, mount_location in sessions:
+            chroot_sessions.setdefault(original_name, []).append((session, mount_location))
+        return chroot_sessions
+
+    def get_chroot_sessions(self, chroot_name):
+        return self.get_all_chroot_sessions().get(chroot_name, [])
+
+    @tracing.traced()
     def terminate_chroot_sessions(self, chroot_name, max_attempts=3):
         '''Best-effort termination of all schroot sessions for chroot_name.
 
         Steps, repeated up to max_attempts:
           1. List sessions for chroot_name.
-          2. fuser --kill -m <mount> for each session that has a mount.
+          2. fuser --kill -m on the mounts of all the sessions at once.
           3. sleep, then re-list.
           4. Stop early if no sessions remain.
 
@@ -359,16 +827,16 @@ class Debbuilder(object):
         as warnings, never raised — this method is preliminary cleanup
         that callers depend on but should not abort on.
         '''
-        sessions = list(self.get_chroot_sessions(chroot_name))
+        sessions = self.get_chroot_sessions(chroot_name)
         if not sessions:
             return
         self.logger.debug('Terminating %d session(s) for %s',
                           len(sessions), chroot_name)
         for attempt in range(1, max_attempts + 1):
-            for session, mount_location in sessions:
-                if not mount_location:
-                    continue
-                cmd = ['fuser', '--kill', '-m', mount_location]
+            mount_locations = [mount_location for _session, mount_location in sessions
+                               if mount_location]
+            if mount_locations:
+                cmd = ['fuser', '--kill', '-m'] + mount_locations
                 self.logger.debug('Attempt %d: %s', attempt, cmd)
                 result = subprocess.run(cmd, stdout=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
@@ -376,13 +844,13 @@ class Debbuilder(object):
                                         check=False)
                 if result.returncode != 0:
                     # fuser returns non-zero when no processes are using
-                    # mount point; worth logging.
+                    # the mount points; worth logging.
                     self.logger.warning(
                         'fuser kill returned rc=%d for %s: %s',
-                        result.returncode, mount_location,
+                        result.returncode, ' '.join(mount_locations),
                         result.stderr.strip())
             time.sleep(1)
-            sessions = list(self.get_chroot_sessions(chroot_name))
+            sessions = self.get_chroot_sessions(chroot_name)
             if not sessions:
                 self.logger.debug(
                     'All sessions for %s terminated after %d attempt(s)',
@@ -391,7 +859,26 @@ class Debbuilder(object):
         self.logger.warning(
             '%d session(s) for %s still alive after %d attempt(s); '
             'forcing end-session', len(sessions), chroot_name, max_attempts)
-        for session, _mount_location in sessions:
+        self.end_sessions([session for session, _mount_location in sessions])
+
+    def end_sessions(self, sessions):
+        '''End the schroot sessions with a single schroot call, and one
+        by one only if the batched call fails.'''
+        cmd = ['schroot', '--end-session']
+        for session in sessions:
+            cmd.extend(['--chroot', session])
+        self.logger.debug('Running: %s', cmd)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True,
+                                check=False)
+        if result.returncode == 0:
+            return
+        remaining = set(session for session, _original_name, _mount_location
+                        in schrootspool.get_schroot_sessions())
+        for session in sessions:
+            if session not in remaining:
+                continue
             cmd = ['schroot', '--end-session', '--chroot', session]
             self.logger.debug('Running: %s', cmd)
             result = subprocess.run(cmd, stdout=subprocess.PIPE,
@@ -466,6 +953,7 @@ class Debbuilder(object):
             response['msg'] = 'Chroot created, please check logs at: %s' % user_schroot_log_path
         return response
 
+    @tracing.traced()
     def save_chroots_config(self, user, project):
         self.logger.debug("Save the config file of chroot to persistent store")
         user_schroot_config_dir = self.get_user_schroot_config_dir(user, project)
@@ -489,12 +977,9 @@ class Debbuilder(object):
         if delete_chroot_dir is not None and os.path.exists(delete_chroot_dir):
             self.logger.debug('Delete chroot at path: %s', delete_chroot_dir)
             try:
-                if utils.is_tmpfs(delete_chroot_dir):
-                    utils.unmount_tmpfs(delete_chroot_dir)
                 self.terminate_chroot_sessions(self.get_cloned_chroot_name(user, index))
-                shell_cmd = 'rm -rf --one-file-system %s' % delete_chroot_dir
-                self.logger.debug('shell_cmd=%s', shell_cmd)
-                subprocess.check_call(shell_cmd, shell=True)
+                backend = self.get_clone_backend(user, project, delete_chroot_dir)
+                backend.remove(delete_chroot_dir)
             except Exception as e:
                 self.logger.error(str(e))
                 self.logger.error("Failed to delete unwanted chroot: %s", delete_chroot_dir)
@@ -633,17 +1118,22 @@ class Debbuilder(object):
 
         user = request_form['user']
         project = request_form['project']
-        if not self.delete_tmpfs_clones(user, project):
-            msg = 'Failed to delete some tmpfs chroots.'
-            self.logger.error(msg)
-            response['status'] = 'fail'
-            response['msg'] = msg
-        else:
-            response['status'] = 'success'
-            response['msg'] = 'tmpfs chroots have been freed'
-        self.chroots_pool.load()
+        with self.refresh_lock:
+            self.pool_owner = None
+            if not self.delete_tmpfs_clones(user, project):
+                msg = 'Failed to delete some tmpfs chroots.'
+                self.logger.error(msg)
+                response['status'] = 'fail'
+                response['msg'] = msg
+            else:
+                response['status'] = 'success'
+                response['msg'] = 'tmpfs chroots have been freed'
+            self.load_pool(user, project)
+            self.set_pool_owner(user, project)
+        self.refresh_event.set()
         return response
 
+    @tracing.traced(root=True)
     def clone_chroot(self, request_form):
         """
         Clone and configure multiple instances of chroots
@@ -651,6 +1141,13 @@ class Debbuilder(object):
         The chroot index file in /etc/schroot/chroot.d also
         need to be cloned to make the chroot can be managed by schroot
         """
+        # Wait for the refresh in progress and keep the background refresher
+        # off the clones while they are deleted and created again
+        with self.refresh_lock:
+            self.pool_owner = None
+            return self._clone_chroot(request_form)
+
+    def _clone_chroot(self, request_form):
         response = check_request(request_form, ['user', 'project', 'instances'])
         if response:
             return response
@@ -658,12 +1155,17 @@ class Debbuilder(object):
         user = request_form['user']
         project = request_form['project']
         required_instances = int(request_form['instances'])
+        backend_name = request_form.get('clone_backend', 'auto')
+        if backend_name not in chrootclone.CLONE_BACKENDS + ['auto']:
+            response['status'] = 'fail'
+            response['msg'] = 'Unknown clone backend %s, choose from: auto,%s' % (
+                              backend_name, ','.join(chrootclone.CLONE_BACKENDS))
+            return response
         tmpfs_instances = 0
         if 'tmpfs_percentage' in request_form.keys():
             tmpfs_percentage = int(request_form['tmpfs_percentage'])
         else:
             tmpfs_percentage = 0
-        chroot_sequence = 1
 
         # Try to find the parent chroot
         # e.g bullseye-amd64-user
@@ -677,9 +1179,8 @@ class Debbuilder(object):
             response['msg'] = 'The parent chroot %s does not exist' % parent_chroot_dir
             return response
 
-        # Capture installed packages on first clone request
-        if not self._parent_installed_pkgs:
-            self._capture_parent_installed_pkgs(parent_chroot_dir)
+        # Index the installed packages, parsed again only if they changed
+        self._parent_dpkg_status.load(parent_chroot_dir)
 
         parent_conf_path = self.get_schroot_conf_path(user)
         if parent_conf_path is None or not os.path.exists(parent_conf_path):
@@ -703,6 +1204,9 @@ class Debbuilder(object):
         # Clean up orphaned schroot configs (configs pointing to non-existent dirs)
         self._cleanup_orphaned_schroot_configs(user, project)
 
+        user_chroots_dir = self.get_user_chroots_dir(user, project)
+        self.clone_backend = chrootclone.get_clone_backend(backend_name, user_chroots_dir, self.logger)
+
         # tmpfs calculations
         mem_per_instance_gb = 0
         if required_instances > 1:
@@ -718,89 +1222,107 @@ class Debbuilder(object):
                 if mem_per_instance_gb >= min_tmpfs_size_gb:
                     break
 
+        if 'clone_workers' in request_form.keys():
+            max_workers = int(request_form['clone_workers'])
+        else:
+            max_workers = min(self.clone_backend.max_workers, os.cpu_count() or 1)
+        max_workers = max(1, min(max_workers, required_instances))
+
         self.logger.debug("The parent chroot %s exists, start to clone chroot from it", parent_chroot_dir)
         self.logger.debug("Creating %s instances, including %s instances using %s gb of tmpfs", required_instances, tmpfs_instances, mem_per_instance_gb)
-        for instance in range(required_instances):
-            cloned_chroot_name = self.get_cloned_chroot_name(user, chroot_sequence)
-            cloned_chroot_dir = self.get_cloned_chroot_dir(user, project, chroot_sequence)
-            clone_conf_path = self.get_schroot_conf_path(user, chroot_sequence)
-
-            if clone_conf_path is None:
-                err_msg = "Failed to determine the schroot config file for %s" % cloned_chroot_name
-                self.logger.error(err_msg)
-                response['status'] = 'fail'
-                response['msg'] = err_msg
-                return response
-
-            use_tmpfs = (instance >= (required_instances - tmpfs_instances))
-
-            # Create new chroot
-            self.logger.info("Cloning chroot %s from the parent %s", cloned_chroot_dir, parent_chroot_dir)
-            try:
-                if use_tmpfs:
-                    os.makedirs(cloned_chroot_dir)
-                    shell_cmd = 'mount -t tmpfs -o size=%sG tmpfs %s' % (mem_per_instance_gb, cloned_chroot_dir)
-                    subprocess.check_call(shell_cmd, shell=True)
-                    shell_cmd = 'cp -ar %s/. %s/' % (parent_chroot_dir, cloned_chroot_dir)
-                    subprocess.check_call(shell_cmd, shell=True)
-                else:
-                    self.logger.info("Cloning chroot %s from the parent %s", cloned_chroot_dir, parent_chroot_dir)
-                    shell_cmd = 'rm -rf %s.tmp' % cloned_chroot_dir
-                    subprocess.check_call(shell_cmd, shell=True)
-                    shell_cmd = 'cp -ar %s %s.tmp' % (parent_chroot_dir, cloned_chroot_dir)
-                    subprocess.check_call(shell_cmd, shell=True)
-                    shell_cmd = 'mv %s.tmp %s' % (cloned_chroot_dir, cloned_chroot_dir)
-                    subprocess.check_call(shell_cmd, shell=True)
-            except Exception as e:
-                self.logger.error(str(e))
-                response['status'] = 'fail'
-                if not response['msg']:
-                    response['msg'] = 'Failed to create chroot instances:'
-                response['msg'].append(str(instance) + ' ')
-                continue
-            else:
-                self.logger.info("Successfully cloned chroot %s", cloned_chroot_dir)
-
-            self.logger.info("Target cloned chroot %s is ready, updating config", cloned_chroot_dir)
-
-            # For the cloned chroot, the schroot config file also need to be created.
-            # Start with the parent schroot as a template and modify it
-            if os.path.exists(clone_conf_path):
-                self.logger.debug("Cloned chroot config %s already exists", clone_conf_path)
-                chroot_sequence = chroot_sequence + 1
-                continue
-            try:
-                self.logger.debug("Creating config file %s from %s", clone_conf_path, parent_conf_path)
-                shutil.copyfile(parent_conf_path, clone_conf_path)
-                self.logger.debug("Successfully cloned chroot config, try to update %s", clone_conf_path)
-                shell_cmd = 'sed -i \'s/%s/%s/g\' %s' % (parent_chroot_name, cloned_chroot_name, clone_conf_path)
-                subprocess.check_call(shell_cmd, shell=True)
-            except Exception as e:
-                self.logger.error(str(e))
-                self.logger.error("Failed to clone and update config file %s", clone_conf_path)
-                continue
-            else:
-                self.logger.debug("Successfully cloned and updated chroot's config %s", clone_conf_path)
-                chroot_sequence = chroot_sequence + 1
-                continue
+        self.logger.debug("Cloning with the %s backend and %d worker(s)", self.clone_backend.name, max_workers)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for instance in range(required_instances):
+                chroot_sequence = instance + 1
+                use_tmpfs = (instance >= (required_instances - tmpfs_instances))
+                tmpfs_size_gb = mem_per_instance_gb if use_tmpfs else 0
+                future = executor.submit(tracing.in_current_trace(self.clone_single_chroot),
+                                         user, project, chroot_sequence,
+                                         parent_conf_path, tmpfs_size_gb)
+                futures[future] = self.get_cloned_chroot_name(user, chroot_sequence)
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                jobmanager.report_progress(len(results), len(futures),
+                                           'cloned %s' % futures[future])
 
         # Save the above chroot config files to the external persistent storage
         self.save_chroots_config(user, project)
 
-        if chroot_sequence == required_instances + 1:
+        created = [name for name, result in results.items() if result['status'] == 'success']
+        response['results'] = results
+        if len(created) == required_instances:
             self.logger.info("All %s required chroots are created", str(required_instances))
             response['status'] = 'success'
             response['msg'] = 'All required chroots are created'
+            response['backend'] = self.clone_backend.name
         else:
             self.logger.info("Not all required %d chroots created, only %d created ok",
-                             required_instances, chroot_sequence - 1)
+                             required_instances, len(created))
             response['status'] = 'fail'
-            response['msg'] = 'Available chroots=%d' % (chroot_sequence - 1)
+            response['msg'] = 'Available chroots=%d' % len(created)
 
-        # Reload all chroots into the chroots pool
-        self.chroots_pool.load()
+        # Reload all chroots into the chroots pool, the new clones are clean
+        self.set_pool_owner(user, project)
+        with tracing.span('pool_load'):
+            self.chroots_pool.load(dirty=False)
         return response
 
+    def clone_single_chroot(self, user, project, chroot_sequence, parent_conf_path, tmpfs_size_gb=0):
+        '''
+        Create one cloned chroot and its schroot config file,
+        this runs in the worker threads of clone_chroot
+        '''
+        result = {'status': 'fail'}
+        parent_chroot_name = self.get_parent_chroot_name(user)
+        parent_chroot_dir = self.get_parent_chroot_dir(user, project)
+        cloned_chroot_name = self.get_cloned_chroot_name(user, chroot_sequence)
+        cloned_chroot_dir = self.get_cloned_chroot_dir(user, project, chroot_sequence)
+        clone_conf_path = '-'.join([parent_conf_path, str(chroot_sequence)])
+
+        # Create new chroot
+        self.logger.info("Cloning chroot %s from the parent %s", cloned_chroot_dir, parent_chroot_dir)
+        start_time = time.time()
+        try:
+            self.clone_backend.create(parent_chroot_dir, cloned_chroot_dir, tmpfs_size_gb)
+        except Exception as e:
+            self.logger.error(str(e))
+            self.logger.error("Failed to clone chroot %s", cloned_chroot_dir)
+            metrics.CLONE_SECONDS.observe(time.time() - start_time,
+                                          backend=self.clone_backend.name, status='fail')
+            result['msg'] = 'Failed to clone chroot: %s' % str(e)
+            return result
+        metrics.CLONE_SECONDS.observe(time.time() - start_time,
+                                      backend=self.clone_backend.name, status='success')
+        self.logger.info("Successfully cloned chroot %s in %.1fs", cloned_chroot_dir,
+                         time.time() - start_time)
+
+        self.logger.info("Target cloned chroot %s is ready, updating config", cloned_chroot_dir)
+
+        # For the cloned chroot, the schroot config file also need to be created.
+        # Start with the parent schroot as a template and modify it
+        if os.path.exists(clone_conf_path):
+            self.logger.debug("Cloned chroot config %s already exists", clone_conf_path)
+            result['status'] = 'success'
+            result['msg'] = cloned_chroot_dir
+            return result
+        try:
+            self.logger.debug("Creating config file %s from %s", clone_conf_path, parent_conf_path)
+            shutil.copyfile(parent_conf_path, clone_conf_path)
+            self.logger.debug("Successfully cloned chroot config, try to update %s", clone_conf_path)
+            shell_cmd = 'sed -i \'s/%s/%s/g\' %s' % (parent_chroot_name, cloned_chroot_name, clone_conf_path)
+            subprocess.check_call(shell_cmd, shell=True)
+        except Exception as e:
+            self.logger.error(str(e))
+            self.logger.error("Failed to clone and update config file %s", clone_conf_path)
+            result['msg'] = 'Failed to create config file: %s' % str(e)
+            return result
+        self.logger.debug("Successfully cloned and updated chroot's config %s", clone_conf_path)
+        result['status'] = 'success'
+        result['msg'] = cloned_chroot_dir
+        return result
+
     def load_chroot(self, request_form):
         response = check_request(request_form, ['user', 'project'])
         if response:
@@ -830,7 +1352,9 @@ class Debbuilder(object):
                 self._cleanup_orphaned_schroot_configs(user, project)
 
         try:
-            self.chroots_pool.load()
+            self.load_pool(user, project)
+            self.set_pool_owner(user, project)
+            self.refresh_event.set()
         except Exception as e:
             self.logger.error("chroots_pool.load() failed: %s", e)
         return response
@@ -872,10 +1396,20 @@ class Debbuilder(object):
                        shell=True, check=False)
         return not os.path.exists(path)
 
+    @tracing.traced()
     def refresh_single_chroot(self, user, project, clone_chroot_name):
         '''
         Refresh a single chroot with the 'clean' parent chroot
         '''
+        start_time = time.time()
+        events.publish('refresh_started', name=clone_chroot_name)
+        response = self._refresh_single_chroot(user, project, clone_chroot_name)
+        metrics.REFRESH_SECONDS.observe(time.time() - start_time, status=response['status'])
+        events.publish('refresh_finished', name=clone_chroot_name, status=response['status'],
+                       msg=response['msg'], duration=time.time() - start_time)
+        return response
+
+    def _refresh_single_chroot(self, user, project, clone_chroot_name):
         response = {}
         response['status'] = 'fail'
 
@@ -904,16 +1438,17 @@ class Debbuilder(object):
         self.logger.info('Refreshing chroot %s (tmpfs: %s)', clone_chroot_name, is_tmpfs)
 
         self.terminate_chroot_sessions(clone_chroot_name)
+        backend = self.get_clone_backend(user, project, clone_chroot_path)
+        start_time = time.time()
 
         # Read lock: allows parallel clones, blocks during parent update
-        self._parent_lock.acquire_read()
+        if not self._parent_lock.acquire_read(PARENT_LOCK_TIMEOUT):
+            self.logger.error('Timed out waiting for the parent chroot to refresh %s',
+                              clone_chroot_name)
+            response['msg'] = 'Timed out waiting for the parent chroot update'
+            return response
         try:
-            if is_tmpfs:
-                utils.clear_directory(clone_chroot_path)
-                subprocess.check_call(
-                    'cp -ar %s/. %s/' % (parent_chroot_path, clone_chroot_path),
-                    shell=True)
-            else:
+            if not is_tmpfs:
                 clone_tmp_path = clone_chroot_path + '.tmp'
                 clone_old_path = clone_chroot_path + '.tmp.old'
                 # Clean up leftovers from previous crashes
@@ -926,17 +1461,10 @@ class Debbuilder(object):
                             'Cannot remove stale .tmp at %s; '
                             'mounts still busy' % stale)
                         return response
-                cp_cmd = 'cp -ra %s %s' % (parent_chroot_path, clone_tmp_path)
-                subprocess.check_call(cp_cmd, shell=True)
-                # Atomic swap via renames
-                if os.path.exists(clone_chroot_path):
-                    os.rename(clone_chroot_path, clone_old_path)
-                os.rename(clone_tmp_path, clone_chroot_path)
-                # Non-critical cleanup of old version
-                subprocess.run(
-                    'rm -rf --one-file-system ' + clone_old_path,
-                    shell=True, check=False)
-        except subprocess.CalledProcessError as e:
+            parent_version = self.parent_version
+            mounted = time.time()
+            backend.refresh(parent_chroot_path, clone_chroot_path, tmpfs=is_tmpfs)
+        except (subprocess.CalledProcessError, OSError) as e:
             for stale in (clone_chroot_path + '.tmp',
                           clone_chroot_path + '.tmp.old'):
                 self.logger.debug('Cleaning up: %s', stale)
@@ -949,30 +1477,82 @@ class Debbuilder(object):
         finally:
             self._parent_lock.release_read()
 
-        self.logger.info('Successfully refreshed the chroot %s', clone_chroot_name)
+        self.logger.info('Successfully refreshed the chroot %s in %.3fs (%s)', clone_chroot_name,
+                         time.time() - start_time, backend.name)
+        self._release_retired_parents(user, project, {clone_chroot_name: mounted})
         response['status'] = 'success'
         response['msg'] = 'Chroot refreshed successfully'
+        response['parent_version'] = parent_version
         return response
 
-    def _capture_parent_installed_pkgs(self, parent_chroot_path):
-        """Capture the set of package names installed in the parent chroot."""
-        dpkg_status = os.path.join(parent_chroot_path, 'var/lib/dpkg/status')
-        pkgs = set()
-        if os.path.exists(dpkg_status):
-            with open(dpkg_status) as f:
-                for line in f:
-                    if line.startswith('Package: '):
-                        pkgs.add(line.split()[1])
-        self._parent_installed_pkgs = pkgs
-        self.logger.info("Parent chroot has %d installed packages", len(pkgs))
+    def _get_mounted_overlay_clones(self, user, project):
+        '''The overlay clones of the user which are mounted'''
+        user_chroots_dir = self.get_user_chroots_dir(user, project)
+        mounts = set()
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[2] == 'overlay':
+                    mounts.add(fields[1])
+        clones = set()
+        for name in os.listdir(user_chroots_dir):
+            if name.endswith(chrootclone.OVERLAY_SUFFIX):
+                clone_name = name[:-len(chrootclone.OVERLAY_SUFFIX)]
+                if os.path.join(user_chroots_dir, clone_name) in mounts:
+                    clones.add(clone_name)
+        return clones
+
+    def _release_retired_parents(self, user, project, remounted=None):
+        '''
+        Remove the old parents kept for the overlay clones once none of
+        them is mounted on it. remounted: {clone name: time} of the clones
+        mounted again on the current parent
+        '''
+        parent_chroot_dir = self.get_parent_chroot_dir(user, project)
+        user_chroots_dir = self.get_user_chroots_dir(user, project)
+        retired_prefix = os.path.basename(parent_chroot_dir) + '.retired-'
+        mounted = self._get_mounted_overlay_clones(user, project)
+        unused = []
+        with self.retired_parents_lock:
+            for name in os.listdir(user_chroots_dir):
+                retired_dir = os.path.join(user_chroots_dir, name)
+                # Retired by a previous instance of the service: any
+                # mounted clone may still use it
+                if name.startswith(retired_prefix) and retired_dir not in self.retired_parents:
+                    self.retired_parents[retired_dir] = (0, set(mounted))
+            for retired_dir, (retired, clones) in list(self.retired_parents.items()):
+                if not retired_dir.startswith(user_chroots_dir + '/'):
+                    continue
+                for clone_name, remount_time in (remounted or {}).items():
+                    if remount_time > retired:
+                        clones.discard(clone_name)
+                clones &= mounted
+                if not clones:
+                    del self.retired_parents[retired_dir]
+                    unused.append(retired_dir)
+        for retired_dir in unused:
+            self.logger.debug("Removing retired parent chroot %s", retired_dir)
+            subprocess.run(f'rm -rf --one-file-system {retired_dir}',
+                           shell=True, check=False)
 
+    @tracing.traced(root=True)
     def update_parent_chroot(self, request_form):
         """Update parent chroot if any built packages overlap with pre-installed ones.
 
         Called by build-pkgs after a package build completes. Checks if any of
         the built binary packages are pre-installed in the parent chroot. If so,
-        acquires write lock (blocks new clones), runs apt upgrade on the parent,
-        then releases.
+        the request joins the pending batch of updates: the batch is collected
+        for 'window' seconds (PARENT_UPDATE_WINDOW by default), or until a
+        request with 'barrier' set to True arrives at the end of a layer, then
+        all its packages are applied in one upgrade. A barrier request without
+        overlapping packages just flushes the pending batch.
+
+        The optional 'debs' argument is a comma-separated list of the built .deb
+        files, the overlapping ones are installed with dpkg -i instead of running
+        a full apt-get dist-upgrade.
+
+        The response reports the generation of this request and the
+        generations of all the requests covered by the same upgrade.
         """
         response = check_request(request_form, ['user', 'project', 'packages'])
         if response:
@@ -980,14 +1560,81 @@ class Debbuilder(object):
 
         user = request_form['user']
         project = request_form['project']
-        # packages = comma-separated list of binary package names just built
-        built_pkgs = set(request_form['packages'].split(','))
-
-        # Check overlap with pre-installed packages
-        overlap = built_pkgs & self._parent_installed_pkgs
-        if not overlap:
-            return {'status': 'success', 'msg': 'no overlap, parent unchanged'}
+        # packages = comma-separated list of binary packages just built,
+        # as 'name' or 'name=version'
+        built_versions = {}
+        for pkg in request_form['packages'].split(','):
+            name, _sep, version = pkg.partition('=')
+            built_versions[name] = version
+        debs = [deb for deb in request_form.get('debs', '').split(',') if deb]
+        deb_names = {}
+        for deb in debs:
+            try:
+                name, version = dpkgstatus.get_deb_fields(deb)
+            except (subprocess.CalledProcessError, OSError, ValueError) as e:
+                self.logger.warning("Failed to read the version of %s: %s", deb, e)
+                name, version = os.path.basename(deb).split('_')[0], ''
+            deb_names[deb] = name
+            if not built_versions.get(name):
+                built_versions[name] = version
+        barrier = request_form.get('barrier') == 'True'
+        window = float(request_form.get('window', PARENT_UPDATE_WINDOW))
+
+        # Check overlap with pre-installed packages older than the built ones
+        self._parent_dpkg_status.load(self.get_parent_chroot_dir(user, project))
+        overlap = set(name for name, version in built_versions.items()
+                      if self._parent_dpkg_status.needs_upgrade(name, version))
+        skipped = [name for name in built_versions
+                   if name not in overlap and self._parent_dpkg_status.get(name)]
+        if skipped:
+            self.logger.debug("Parent chroot already has the same or newer: %s",
+                              ','.join(sorted(skipped)[:5]))
+        key = (user, project)
+        with self._parent_batches_lock:
+            batch = self._parent_update_batches.get(key)
+            if not overlap and not (barrier and batch):
+                return {'status': 'success', 'msg': 'no overlap, parent unchanged'}
+            self._parent_update_generation += 1
+            generation = self._parent_update_generation
+            leader = batch is None
+            if leader:
+                batch = _ParentUpdateBatch()
+                self._parent_update_batches[key] = batch
+            overlap_debs = [deb for deb in debs if deb_names[deb] in overlap]
+            batch.add(generation, overlap, overlap_debs)
+            if barrier:
+                batch.flush.set()
+
+        if leader:
+            batch.flush.wait(window)
+            # Requests arriving from now on go to the next batch
+            with self._parent_batches_lock:
+                del self._parent_update_batches[key]
+            start_time = time.time()
+            try:
+                response = self._upgrade_parent_chroot(user, project, batch.packages, batch.debs)
+            except Exception as e:
+                self.logger.exception("Parent chroot update failed")
+                response = {'status': 'fail', 'msg': 'parent chroot update failed: %s' % e}
+            metrics.PARENT_UPGRADE_SECONDS.observe(time.time() - start_time,
+                                                   status=response['status'])
+            response['generations'] = sorted(batch.generations)
+            events.publish('parent_upgraded', user=user, project=project,
+                           status=response['status'], msg=response['msg'],
+                           packages=sorted(batch.packages), generations=response['generations'])
+            batch.response = response
+            batch.done.set()
+        elif not batch.done.wait(PARENT_UPDATE_WAIT):
+            self.logger.error("Timed out after %ds waiting for the parent chroot update",
+                              PARENT_UPDATE_WAIT)
+            return {'status': 'fail', 'generation': generation,
+                    'msg': 'timed out waiting for the parent chroot update'}
+        response = dict(batch.response)
+        response['generation'] = generation
+        return response
 
+    @tracing.traced()
+    def _upgrade_parent_chroot(self, user, project, overlap, debs):
         self.logger.info("Parent chroot update needed: %d overlapping package(s): %s",
                          len(overlap), ','.join(sorted(overlap)[:5]))
 
@@ -995,9 +1642,9 @@ class Debbuilder(object):
         if not os.path.exists(parent_chroot_dir):
             return {'status': 'fail', 'msg': 'parent chroot not found'}
 
-        # Acquire write lock — waits for all in-progress clones to finish
-        self._parent_lock.acquire_write()
-        try:
+        # Parent updates run one at a time, clones go on reading the parent
+        # until the upgraded staging chroot is ready
+        with self._parent_update_lock:
             # Stale mount detection: clean up mounts left by interrupted upgrades
             proc_path = os.path.join(parent_chroot_dir, 'proc')
             sys_path = os.path.join(parent_chroot_dir, 'sys')
@@ -1014,100 +1661,291 @@ class Debbuilder(object):
                         return {'status': 'fail',
                                 'msg': f'cannot unmount stale {mnt}, manual cleanup required'}
 
-            # Copy-then-swap: upgrade on a staging copy, swap atomically on success
             staging_dir = parent_chroot_dir + '.upgrading'
+            staging_layer_dir = staging_dir + chrootclone.OVERLAY_SUFFIX
             old_dir = parent_chroot_dir + '.pre-upgrade'
+            applying_dir = parent_chroot_dir + '.applying'
 
             # Clean up leftovers from previous interrupted upgrades
-            for stale in (staging_dir, old_dir):
-                if os.path.exists(stale):
-                    self.logger.warning("Removing stale dir from prior interrupted upgrade: %s", stale)
-                    # Unmount anything inside before removal
-                    res = subprocess.run(f'findmnt -rn -o TARGET {stale}',
-                                         shell=True, capture_output=True)
-                    stale_mounts = res.stdout.decode(errors='replace').strip()
-                    if stale_mounts:
-                        self.logger.warning("Unmounting stale mounts in %s", stale)
-                        res2 = subprocess.run(f'umount -R {stale}',
-                                              shell=True, capture_output=True)
-                        if res2.returncode != 0:
-                            self.logger.error("Cannot unmount %s: %s; skipping cleanup",
-                                              stale, res2.stderr.decode(errors='replace').strip())
-                            continue
-                    subprocess.run(f'rm -rf --one-file-system {stale}',
-                                   shell=True, check=False)
-
-            # Create staging copy
-            self.logger.info("Creating staging copy of parent chroot for upgrade")
-            res = subprocess.run(f'cp -ar {parent_chroot_dir} {staging_dir}',
-                                 shell=True, capture_output=True)
-            if res.returncode != 0:
-                self.logger.error("Failed to create staging copy: %s",
-                                  res.stderr.decode(errors='replace')[-500:])
-                return {'status': 'fail', 'msg': 'failed to create staging copy'}
+            for stale in (staging_dir, staging_layer_dir, old_dir, applying_dir):
+                self._remove_stale_upgrade_dir(stale)
+
+            # Overlay clones read the parent as their lower dir, which an
+            # overlay staging chroot can not be mounted on: they get a new
+            # parent by copy-then-swap instead. Applying the layer needs a
+            # copy of the parent too, only cheaper with shared extents
+            use_layer = self.get_clone_backend(user, project).name != 'overlay' and \
+                chrootclone.supports_reflink(self.get_user_chroots_dir(user, project))
+            for use_debs in ([True, False] if debs else [False]):
+                upgrade_debs = debs if use_debs else []
+                if use_layer and self._mount_staging_layer(parent_chroot_dir, staging_dir):
+                    response = self._update_parent_from_layer(user, project, staging_dir,
+                                                              applying_dir, old_dir,
+                                                              upgrade_debs)
+                else:
+                    response = self._update_parent_by_swap(user, project, staging_dir,
+                                                           old_dir, upgrade_debs)
+                if response['status'] == 'success' or not use_debs:
+                    break
+                self.logger.warning("Installing the built packages failed, retrying with apt-get dist-upgrade")
+            if response['status'] != 'success':
+                return response
 
-            # Mount /proc and /sys in the staging copy
-            staging_proc = os.path.join(staging_dir, 'proc')
-            staging_sys = os.path.join(staging_dir, 'sys')
-            res = subprocess.run(f'mount -t proc proc {staging_proc}',
-                                 shell=True, capture_output=True)
-            if res.returncode != 0:
-                self.logger.warning("Failed to mount proc in staging chroot: %s",
-                                    res.stderr.decode(errors='replace').strip())
-            res = subprocess.run(f'mount --rbind /sys {staging_sys}',
-                                 shell=True, capture_output=True)
-            if res.returncode != 0:
-                self.logger.warning("Failed to mount sys in staging chroot: %s",
-                                    res.stderr.decode(errors='replace').strip())
-            try:
+            # Refresh the installed packages index
+            self._parent_dpkg_status.load(parent_chroot_dir)
+            self.logger.info("Parent chroot updated successfully")
+            # The idle chroots were cloned from the old parent, the busy
+            # ones come back dirty anyway
+            self.chroots_pool.mark_dirty()
+            self.refresh_event.set()
+            return {'status': 'success',
+                    'msg': f'upgraded {len(overlap)} package(s)'}
+
+    def _remove_stale_upgrade_dir(self, stale):
+        if not os.path.exists(stale):
+            return
+        self.logger.warning("Removing stale dir from prior interrupted upgrade: %s", stale)
+        # Unmount anything inside before removal
+        res = subprocess.run(f'findmnt -rn -o TARGET {stale}',
+                             shell=True, capture_output=True)
+        stale_mounts = res.stdout.decode(errors='replace').strip()
+        if stale_mounts:
+            self.logger.warning("Unmounting stale mounts in %s", stale)
+            res2 = subprocess.run(f'umount -R {stale}',
+                                  shell=True, capture_output=True)
+            if res2.returncode != 0:
+                self.logger.error("Cannot unmount %s: %s; skipping cleanup",
+                                  stale, res2.stderr.decode(errors='replace').strip())
+                return
+        subprocess.run(f'rm -rf --one-file-system {stale}',
+                       shell=True, check=False)
+
+    def _upgrade_staging_chroot(self, staging_dir, debs):
+        """Upgrade the staging chroot, with dpkg -i of debs if given or else
+        with apt-get dist-upgrade. Returns an error message on failure."""
+        # Mount /proc and /sys in the staging chroot
+        staging_proc = os.path.join(staging_dir, 'proc')
+        staging_sys = os.path.join(staging_dir, 'sys')
+        res = subprocess.run(f'mount -t proc proc {staging_proc}',
+                             shell=True, capture_output=True)
+        if res.returncode != 0:
+            self.logger.warning("Failed to mount proc in staging chroot: %s",
+                                res.stderr.decode(errors='replace').strip())
+        res = subprocess.run(f'mount --rbind /sys {staging_sys}',
+                             shell=True, capture_output=True)
+        if res.returncode != 0:
+            self.logger.warning("Failed to mount sys in staging chroot: %s",
+                                res.stderr.decode(errors='replace').strip())
+        try:
+            if debs:
+                # Install just the freshly built packages
+                deb_dir = os.path.join(staging_dir, 'tmp/parent-upgrade')
+                os.makedirs(deb_dir, exist_ok=True)
+                for deb in debs:
+                    shutil.copy(deb, deb_dir)
+                cmd = (
+                    f"chroot {staging_dir} /bin/bash -c "
+                    f"'dpkg -i --force-confdef --force-confold /tmp/parent-upgrade/*.deb'"
+                )
+            else:
                 # Run apt upgrade inside the staging chroot
                 cmd = (
                     f"chroot {staging_dir} /bin/bash -c "
                     f"'apt-get update -q && "
                     f"apt-get dist-upgrade -y -q --allow-downgrades "
                     f"-o Dpkg::Options::=\"--force-confdef\" "
-                    f"-o Dpkg::Options::=\"--force-confold\"'"
+                    f"-o Dpkg::Options::=\"--force-confold\" && "
+                    f"apt-get clean'"
                 )
-                result = subprocess.run(cmd, shell=True,
-                                        capture_output=True, timeout=300)
-                if result.returncode != 0:
-                    self.logger.error("Parent chroot upgrade failed: %s",
-                                      result.stderr.decode(errors='replace')[-500:])
-                    # Upgrade failed — discard staging, parent unchanged
-                    subprocess.run(f'rm -rf --one-file-system {staging_dir}',
-                                   shell=True, check=False)
-                    return {'status': 'fail', 'msg': 'apt upgrade failed'}
-                else:
-                    self.logger.debug("apt dist-upgrade output: %s",
-                                      result.stdout.decode(errors='replace')[-1000:])
-            finally:
-                # Always unmount before swap
-                res = subprocess.run(f'umount -R {staging_sys}',
-                                     shell=True, capture_output=True)
-                if res.returncode != 0:
-                    self.logger.warning("umount -R %s: %s", staging_sys,
-                                        res.stderr.decode(errors='replace').strip())
-                res = subprocess.run(f'umount {staging_proc}',
-                                     shell=True, capture_output=True)
-                if res.returncode != 0:
-                    self.logger.warning("umount %s: %s", staging_proc,
-                                        res.stderr.decode(errors='replace').strip())
+            # In its own session to kill dpkg or apt-get too on timeout,
+            # they would keep the staging chroot busy
+            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, start_new_session=True)
+            try:
+                stdout, stderr = process.communicate(timeout=PARENT_UPGRADE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                self.logger.error("Parent chroot upgrade timed out after %ds",
+                                  PARENT_UPGRADE_TIMEOUT)
+                return 'dpkg install timed out' if debs else 'apt upgrade timed out'
+            if debs:
+                shutil.rmtree(deb_dir, ignore_errors=True)
+            if process.returncode != 0:
+                self.logger.error("Parent chroot upgrade failed: %s",
+                                  stderr.decode(errors='replace')[-500:])
+                return 'dpkg install failed' if debs else 'apt upgrade failed'
+            self.logger.debug("Parent chroot upgrade output: %s",
+                              stdout.decode(errors='replace')[-1000:])
+        finally:
+            # Always unmount before swap
+            res = subprocess.run(f'umount -R {staging_sys}',
+                                 shell=True, capture_output=True)
+            if res.returncode != 0:
+                self.logger.warning("umount -R %s: %s", staging_sys,
+                                    res.stderr.decode(errors='replace').strip())
+            res = subprocess.run(f'umount {staging_proc}',
+                                 shell=True, capture_output=True)
+            if res.returncode != 0:
+                self.logger.warning("umount %s: %s", staging_proc,
+                                    res.stderr.decode(errors='replace').strip())
+        return None
+
+    def _update_parent_by_swap(self, user, project, staging_dir, old_dir, debs):
+        """Upgrade a copy of the parent and swap it in place of the parent."""
+        parent_chroot_dir = self.get_parent_chroot_dir(user, project)
+        # Create staging copy, with shared extents where the filesystem allows
+        self.logger.info("Creating staging copy of parent chroot for upgrade")
+        res = subprocess.run(f'cp -a --reflink=auto {parent_chroot_dir} {staging_dir}',
+                             shell=True, capture_output=True)
+        if res.returncode != 0:
+            self.logger.error("Failed to create staging copy: %s",
+                              res.stderr.decode(errors='replace')[-500:])
+            subprocess.run(f'rm -rf --one-file-system {staging_dir}',
+                           shell=True, check=False)
+            return {'status': 'fail', 'msg': 'failed to create staging copy'}
+
+        error = self._upgrade_staging_chroot(staging_dir, debs)
+        if error:
+            # Upgrade failed — discard staging, parent unchanged
+            subprocess.run(f'rm -rf --one-file-system {staging_dir}',
+                           shell=True, check=False)
+            return {'status': 'fail', 'msg': error}
 
-            # Atomic swap: rename old parent away, rename staging in place
+        response = self._swap_parent(user, project, staging_dir, old_dir)
+        if response['status'] != 'success':
+            subprocess.run(f'rm -rf --one-file-system {staging_dir}',
+                           shell=True, check=False)
+        return response
+
+    def _swap_parent(self, user, project, new_dir, old_dir):
+        """Swap new_dir in place of the parent. The old parent is kept
+        while overlay clones are mounted on it, else it is removed."""
+        parent_chroot_dir = self.get_parent_chroot_dir(user, project)
+        # Write lock only for the swap — waits for in-progress clones to finish
+        if not self._parent_lock.acquire_write(PARENT_LOCK_TIMEOUT):
+            self.logger.error("Timed out waiting for the clones to release the parent chroot")
+            return {'status': 'fail', 'msg': 'timed out waiting for the parent chroot lock'}
+        try:
+            # Atomic swap: rename old parent away, rename the new one in place
             os.rename(parent_chroot_dir, old_dir)
-            os.rename(staging_dir, parent_chroot_dir)
+            os.rename(new_dir, parent_chroot_dir)
+            self.parent_version += 1
+            # All the overlay clones mounted so far have the old parent as
+            # their lower dir, idle or busy
+            retired = time.time()
+            mounted = self._get_mounted_overlay_clones(user, project)
+        finally:
+            self._parent_lock.release_write()
+        if mounted:
+            retired_dir = '%s.retired-%d' % (parent_chroot_dir, int(retired))
+            self.logger.info("Keeping the old parent at %s for %d mounted overlay clone(s)",
+                             retired_dir, len(mounted))
+            os.rename(old_dir, retired_dir)
+            with self.retired_parents_lock:
+                self.retired_parents[retired_dir] = (retired, mounted)
+        else:
             # Non-critical cleanup of old version
             subprocess.run(f'rm -rf --one-file-system {old_dir}',
                            shell=True, check=False)
+        self._release_retired_parents(user, project)
+        return {'status': 'success'}
+
+    def _mount_staging_layer(self, parent_chroot_dir, staging_dir):
+        """Mount the staging chroot as an overlay on the parent, so that the
+        upgrade writes only the changed files. Returns False if the overlay
+        can not be used, redirect_dir and metacopy must be off to be able to
+        apply the upper dir to the parent as plain files."""
+        layer_dir = staging_dir + chrootclone.OVERLAY_SUFFIX
+        upper_dir = os.path.join(layer_dir, 'upper')
+        work_dir = os.path.join(layer_dir, 'work')
+        for path in (upper_dir, work_dir, staging_dir):
+            os.makedirs(path, exist_ok=True)
+        res = subprocess.run(f'mount -t overlay overlay -o lowerdir={parent_chroot_dir},'
+                             f'upperdir={upper_dir},workdir={work_dir},'
+                             f'redirect_dir=off,metacopy=off,index=off {staging_dir}',
+                             shell=True, capture_output=True)
+        if res.returncode != 0:
+            self.logger.warning("Cannot stage the parent upgrade in an overlay: %s",
+                                res.stderr.decode(errors='replace').strip())
+            subprocess.run(f'rm -rf --one-file-system {staging_dir} {layer_dir}',
+                           shell=True, check=False)
+            return False
+        return True
 
-            # Refresh the installed packages list
-            self._capture_parent_installed_pkgs(parent_chroot_dir)
-            self.logger.info("Parent chroot updated successfully")
-            return {'status': 'success',
-                    'msg': f'upgraded {len(overlap)} package(s)'}
+    def _update_parent_from_layer(self, user, project, staging_dir, applying_dir,
+                                  old_dir, debs):
+        """Upgrade the overlay staging chroot, apply its upper dir, the files
+        changed by the upgrade, to a reflink copy of the parent and swap the
+        copy in place of the parent. A failure leaves the parent unchanged."""
+        parent_chroot_dir = self.get_parent_chroot_dir(user, project)
+        layer_dir = staging_dir + chrootclone.OVERLAY_SUFFIX
+        upper_dir = os.path.join(layer_dir, 'upper')
+        try:
+            try:
+                error = self._upgrade_staging_chroot(staging_dir, debs)
+            finally:
+                subprocess.run(f'umount {staging_dir}', shell=True, check=False)
+            if error:
+                return {'status': 'fail', 'msg': error}
+            res = subprocess.run(f'cp -a --reflink=always {parent_chroot_dir} {applying_dir}',
+                                 shell=True, capture_output=True)
+            if res.returncode != 0:
+                self.logger.error("Failed to copy the parent chroot: %s",
+                                  res.stderr.decode(errors='replace')[-500:])
+                return {'status': 'fail', 'msg': 'failed to copy the parent chroot'}
+            try:
+                self._apply_upper_dir(upper_dir, applying_dir)
+            except (subprocess.CalledProcessError, OSError) as e:
+                self.logger.error("Failed to apply the upgrade to the parent chroot: %s", e)
+                return {'status': 'fail', 'msg': 'failed to apply the upgrade to the parent'}
+            return self._swap_parent(user, project, applying_dir, old_dir)
         finally:
-            self._parent_lock.release_write()
+            subprocess.run(f'rm -rf --one-file-system {staging_dir} {layer_dir} {applying_dir}',
+                           shell=True, check=False)
 
+    def _apply_upper_dir(self, upper_dir, target_dir):
+        """Apply an overlay upper dir to target_dir: whiteouts delete the
+        target entries, opaque dirs replace them and the rest is copied over."""
+        removed = []
+        whiteouts = []
+        for root, dirs, files in os.walk(upper_dir):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, upper_dir)
+                st = os.lstat(path)
+                if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+                    removed.append(rel_path)
+                    whiteouts.append(rel_path)
+                elif stat.S_ISDIR(st.st_mode):
+                    try:
+                        opaque = os.getxattr(path, 'trusted.overlay.opaque',
+                                             follow_symlinks=False) == b'y'
+                    except OSError:
+                        opaque = False
+                    if opaque:
+                        removed.append(rel_path)
+        for rel_path in removed:
+            target = os.path.join(target_dir, rel_path)
+            if os.path.lexists(target):
+                subprocess.check_call(['rm', '-rf', '--one-file-system', target])
+        self.logger.info("Applying %d changed path(s) to %s",
+                         sum(len(files) for _root, _dirs, files in os.walk(upper_dir)) - len(whiteouts),
+                         target_dir)
+        with tempfile.NamedTemporaryFile('w', prefix='whiteouts-') as exclude:
+            for rel_path in whiteouts:
+                exclude.write('./%s\n' % rel_path)
+            exclude.flush()
+            # Keep the file capabilities and the other xattrs, not the
+            # ones of the overlay itself
+            xattrs = "--xattrs --xattrs-include='*' --xattrs-exclude='trusted.overlay.*'"
+            subprocess.check_call(f'set -o pipefail; '
+                                  f'tar -C {upper_dir} {xattrs} --no-wildcards --anchored '
+                                  f'--exclude-from={exclude.name} -cf - . | '
+                                  f'tar -C {target_dir} {xattrs} -xpf -',
+                                  shell=True, executable='/bin/bash')
+
+    @tracing.traced(root=True)
     def refresh_chroots(self, request_form):
         '''
         Refresh all chroots with the 'clean' parent chroot
@@ -1137,56 +1975,105 @@ class Debbuilder(object):
             response['status'] = 'fail'
             response['msg'] = 'The parent chroot does not exist'
             return response
+        self.set_pool_owner(user, project)
 
+        claimed = []
         for clone_chroot_name in dst_chroots:
             if parent_chroot_name == clone_chroot_name:
                 continue
+            if not self.chroots_pool.claim_refresh(clone_chroot_name):
+                self.logger.debug('%s is being refreshed in the background', clone_chroot_name)
+                continue
+            claimed.append(clone_chroot_name)
 
-            refresh_result = self.refresh_single_chroot(user, project, clone_chroot_name)
-            if refresh_result['status'] != 'success':
-                response['status'] = 'fail'
-                response['msg'] = f"Failed to refresh {clone_chroot_name}: {refresh_result['msg']}"
-                return response
+        # The refreshes share the read lock of the parent chroot, so they
+        # run in parallel and are bound by the IO bandwidth
+        if 'refresh_workers' in request_form.keys():
+            max_workers = int(request_form['refresh_workers'])
+        else:
+            max_workers = min(self.get_clone_backend(user, project).max_workers, os.cpu_count() or 1)
+        max_workers = max(1, min(max_workers, len(claimed)))
+        self.logger.debug("Refreshing %d chroot(s) with %d worker(s)", len(claimed), max_workers)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for clone_chroot_name in claimed:
+                future = executor.submit(tracing.in_current_trace(self._refresh_claimed_chroot),
+                                         user, project, clone_chroot_name)
+                futures[future] = clone_chroot_name
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                jobmanager.report_progress(len(results), len(futures),
+                                           'refreshed %s' % futures[future])
+
+        failed = sorted(name for name, result in results.items() if result['status'] != 'success')
+        response['results'] = results
+        if failed:
+            self.logger.error('Failed to refresh %d of %d chroots: %s', len(failed),
+                              len(results), ','.join(failed))
+            response['status'] = 'fail'
+            response['msg'] = 'Failed to refresh %d of %d chroots: %s' % (
+                len(failed), len(results), ','.join(failed))
+            return response
 
         self.logger.info('Successfully refreshed all idle chroots')
         response['status'] = 'success'
         response['msg'] = 'All idle chroots are refreshed'
         return response
 
+    def _refresh_claimed_chroot(self, user, project, clone_chroot_name):
+        '''Refresh a chroot claimed from the pool and give it back'''
+        try:
+            refresh_result = self.refresh_single_chroot(user, project, clone_chroot_name)
+        except Exception as e:
+            self.logger.error("Refresh of %s failed: %s", clone_chroot_name, e)
+            refresh_result = {'status': 'fail', 'msg': str(e)}
+        self.chroots_pool.finish_refresh(clone_chroot_name, self._is_refreshed(refresh_result))
+        return refresh_result
+
+    def _is_refreshed(self, refresh_result):
+        '''Whether the chroot is clean: refreshed from the current parent'''
+        return refresh_result['status'] == 'success' and \
+            refresh_result.get('parent_version', self.parent_version) == self.parent_version
+
+    @tracing.traced()
     def assemble_extra_repo(self, snapshot_idx, repo=""):
-        repomgr_url = None
-        if not os.path.exists(STX_LOCALRC):
+        env_vars = self.get_localrc_vars()
+        if env_vars is None:
             self.logger.warning('stx-localrc does not exist')
             return None
 
-        env_list = []
-        with open(STX_LOCALRC) as f:
-            env_list = list(f)
-        for item in env_list:
-            if item.startswith('export '):
-                envvar = item.replace('export ', '').split('=')
-                if envvar and len(envvar) >= 2 and envvar[0].strip() == 'REPOMGR_DEPLOY_URL':
-                    repomgr_url = envvar[1].strip()
-                    break
+        key = (snapshot_idx, repo)
+        with self.localrc_lock:
+            if key in self.extra_repo_urls:
+                return self.extra_repo_urls[key]
 
+        repomgr_url = env_vars.get('REPOMGR_DEPLOY_URL')
         if repomgr_url:
             if repo:
                 repomgr_url = f"deb [trusted=yes] {repomgr_url}{repo} {self.attrs['dist']} main"
             else:
                 repomgr_url = ' '.join(['deb [trusted=yes]', repomgr_url + REPO_BUILD + '-' + snapshot_idx, self.attrs['dist'], 'main'])
         self.logger.warning("The extra repository URL is %s", repomgr_url)
+        with self.localrc_lock:
+            # Not kept if stx-localrc was reloaded meanwhile
+            if self.localrc_vars is env_vars:
+                self.extra_repo_urls[key] = repomgr_url
         return repomgr_url
 
+    @tracing.traced(root=True)
     def add_task(self, request_form):
         response = check_request(request_form,
-                                 ['user', 'project', 'type', 'dsc', 'snapshot_idx', 'layer', 'size', 'allow_tmpfs'])
+                                 ['user', 'project', 'type', 'dsc', 'snapshot_idx', 'layer', 'size',
+                                  'allow_tmpfs', 'run_tests'])
         if response:
             return response
         user = request_form['user']
+        project = request_form['project']
         snapshot_index = request_form['snapshot_idx']
         layer = request_form['layer']
         size = request_form['size']
-        allow_tmpfs = request_form['allow_tmpfs']
+        allow_tmpfs = str(request_form['allow_tmpfs']).lower() in ('true', '1')
 
         chroot_name = self.compose_chroot_name(user)
         if not self.has_chroot(chroot_name):
@@ -1206,49 +2093,107 @@ class Debbuilder(object):
         bcommand = ' '.join(['nice', '-n', '15', 'ionice', '-c', '3',
                              BUILD_ENGINE, '-d', self.attrs['dist']])
         dsc_build_dir = os.path.dirname(dsc)
-        chroot = self.chroots_pool.acquire(needed_size=size, allow_tmpfs=allow_tmpfs)
+        # Optionally hold the request until a chroot is released. While
+        # waiting, the tasks with a higher priority (e.g. the number of
+        # packages in the layer depending on this one) are served first
+        # Check the parameters before taking a chroot, the build can not
+        # fail on them once the chroot is taken
+        try:
+            wait_timeout = int(request_form.get('wait', 0))
+            priority = int(request_form.get('priority', 0))
+            # 'auto' or no 'jobs' sizes the parallelism from the build history
+            requested_jobs = request_form.get('jobs', 'auto')
+            requested_jobs = 0 if requested_jobs == 'auto' else int(requested_jobs)
+            memory = int(request_form.get('memory', 0)) * 1024 * 1024
+            io_weight = int(request_form.get('io_weight', 0))
+            if min(requested_jobs, memory, io_weight) < 0:
+                raise ValueError('negative jobs, memory or io_weight')
+            schrootspool.human_readable_to_bytes(size)
+        except ValueError as e:
+            self.logger.error("Invalid build parameters for %s: %s", dsc, e)
+            response['status'] = 'fail'
+            response['msg'] = 'Invalid build parameters: %s' % e
+            return response
+        with tracing.span('acquire', size=size, wait=wait_timeout):
+            chroot = self.chroots_pool.acquire(needed_size=size, allow_tmpfs=allow_tmpfs,
+                                               timeout=wait_timeout, priority=priority,
+                                               owner=os.path.basename(dsc))
         self.chroots_pool.show()
         if not chroot:
             self.logger.error("There is not idle chroot for %s", dsc)
             response['status'] = 'fail'
             response['msg'] = 'There is not idle chroot for ' + dsc
+            response['queue_length'] = self.chroots_pool.get_queue_length()
             return response
 
-        # Refresh the chroot before using it for the build
-        project = request_form['project']
-        refresh_result = self.refresh_single_chroot(user, project, chroot)
-        if refresh_result['status'] != 'success':
-            self.logger.warning("Failed to refresh chroot %s: %s", chroot, refresh_result['msg'])
-            # Continue anyway - refresh failure shouldn't block the build
+        # Until the build is started, a failure gives the chroot back
+        cgroup = None
+        try:
+            # Refresh the chroot before using it for the build, unless the
+            # background refresher already did it
+            self.set_pool_owner(user, project)
+            if self.chroots_pool.is_dirty(chroot):
+                refresh_result = self.refresh_single_chroot(user, project, chroot)
+                if refresh_result['status'] != 'success':
+                    self.logger.warning("Failed to refresh chroot %s: %s", chroot, refresh_result['msg'])
+                    # Continue anyway - refresh failure shouldn't block the build
+            else:
+                self.logger.debug("Chroot %s was refreshed in the background", chroot)
 
-        self.chroots_state[dsc] = chroot
-        self.logger.info("Chroot %s is ready for %s", chroot, dsc)
+            with self.tasks_lock:
+                self.chroots_state[dsc] = chroot
+                self.task_results.pop(dsc, None)
+            self.logger.info("Chroot %s is ready for %s", chroot, dsc)
 
-        if 'jobs' in request_form:
-            jobs = '-j' + request_form['jobs']
-        else:
-            jobs = '-j4'
+            jobs = '-j%d' % self.allocate_jobs(dsc, requested_jobs)
 
-        repo_url = self.assemble_extra_repo(snapshot_index)
-        extra_repo = '--extra-repository=\'%s\'' % (repo_url)
+            repo_url = self.assemble_extra_repo(snapshot_index)
+            extra_repo = '--extra-repository=\'%s\'' % (repo_url)
 
-        layer_url = self.assemble_extra_repo(
-            snapshot_index, repo=f"deb-local-binary-{layer}"
-        )
-        layer_repo = '--extra-repository=\'%s\'' % (layer_url)
+            layer_url = self.assemble_extra_repo(
+                snapshot_index, repo=f"deb-local-binary-{layer}"
+            )
+            layer_repo = '--extra-repository=\'%s\'' % (layer_url)
 
-        bcommand = ' '.join([bcommand, jobs, '-c', chroot, layer_repo, extra_repo,
-                            '--build-dir', dsc_build_dir, dsc])
-        self.logger.debug("Build command: %s" % (bcommand))
-        self.attrs['state'] = 'works'
+            bcommand = ' '.join([bcommand, jobs, '-c', chroot, layer_repo, extra_repo,
+                                '--build-dir', dsc_build_dir, dsc])
+            self.logger.debug("Build command: %s" % (bcommand))
+            self.attrs['state'] = 'works'
 
-        # verify if tests need to be executed
-        if request_form['run_tests'] == 'True':
-            p = subprocess.Popen(bcommand, shell=True, preexec_fn=os.setsid)
-        else:
-            self.logger.debug("No tests needed, setting DEB_BUILD_OPTIONS=nocheck")
-            p = subprocess.Popen(bcommand, shell=True, env={**os.environ, 'DEB_BUILD_OPTIONS': 'nocheck'}, preexec_fn=os.setsid)
-        self.sbuild_processes.setdefault(user, {}).setdefault(dsc, p)
+            # Run the build in its own cgroup: limited to the CPUs of its jobs,
+            # to 'memory' MiB and to the 'io_weight', and accounted. The shell
+            # joins the cgroup before it execs sbuild
+            if self.cgroup_controllers is not None:
+                cgroup = cgroups.BuildCgroup(os.path.basename(dsc))
+                try:
+                    cgroup.create(cpus=int(jobs[2:]), memory=memory, io_weight=io_weight)
+                    bcommand = cgroup.wrap_command(bcommand)
+                except (OSError, ValueError) as e:
+                    self.logger.warning("Failed to create the cgroup for %s: %s", dsc, e)
+                    cgroup.remove()
+                    cgroup = None
+
+            # verify if tests need to be executed
+            with tracing.span('sbuild_start', chroot=chroot, jobs=jobs):
+                if request_form['run_tests'] == 'True':
+                    p = subprocess.Popen(bcommand, shell=True, start_new_session=True)
+                else:
+                    self.logger.debug("No tests needed, setting DEB_BUILD_OPTIONS=nocheck")
+                    p = subprocess.Popen(bcommand, shell=True, env={**os.environ, 'DEB_BUILD_OPTIONS': 'nocheck'}, start_new_session=True)
+            with self.tasks_lock:
+                self.sbuild_processes.setdefault(user, {}).setdefault(dsc, p)
+                self.task_start_times[dsc] = time.time()
+                self.task_create_times[dsc] = poolstate.get_create_time(p.pid)
+                if cgroup:
+                    self.task_cgroups[dsc] = cgroup
+        except Exception as e:
+            self.logger.error("Failed to start the build of %s: %s", dsc, e)
+            self._abort_task(dsc, chroot, cgroup)
+            response['status'] = 'fail'
+            response['msg'] = 'Failed to start the build of ' + dsc
+            return response
+        self.save_tasks()
+        events.publish('task_started', dsc=dsc, chroot=chroot, pid=p.pid)
 
         response['status'] = 'success'
         response['msg'] = chroot
@@ -1277,6 +2222,37 @@ class Debbuilder(object):
             response['msg'] = 'Successfully cleaned the stamp directory'
         return response
 
+    def get_trace(self, request_form):
+        '''
+        The recent spans, of the request 'trace_id' if given, as a list
+        or with 'format=chrome' as a Chrome trace
+        '''
+        spans = tracing.get_spans(request_form.get('trace_id'))
+        if request_form.get('format') == 'chrome':
+            return tracing.to_chrome_trace(spans)
+        response = {}
+        response['status'] = 'success'
+        response['msg'] = '%d span(s)' % len(spans)
+        response['spans'] = spans
+        return response
+
+    def get_events(self, request_form):
+        '''
+        The events after the sequence number 'since', waiting up to
+        'timeout' seconds for new ones (long-poll)
+        '''
+        since = int(request_form.get('since', 0))
+        timeout = min(float(request_form.get('timeout', 0)), events.MAX_WAIT)
+        response = {}
+        response['status'] = 'success'
+        if timeout > 0:
+            response['events'] = events.event_bus.wait(since, timeout)
+        else:
+            response['events'] = events.event_bus.get_events(since)
+        response['seq'] = events.event_bus.get_seq()
+        response['msg'] = '%d event(s)' % len(response['events'])
+        return response
+
     def kill_task(self, request_form):
         response = check_request(request_form, ['user', 'owner'])
         if response:
@@ -1287,28 +2263,30 @@ class Debbuilder(object):
         if 'dsc' in request_form:
             done_dsc = request_form['dsc']
             if done_dsc:
-                self.chroots_pool.release(self.chroots_state[done_dsc])
-                self.logger.debug('The chroot %s for %s is released', self.chroots_state[done_dsc], done_dsc)
-                for dsckey in self.sbuild_processes[user].keys():
-                    if dsckey == done_dsc:
-                        self.logger.debug("Terminating package build process for %s", dsckey)
-                        p = self.sbuild_processes[user][dsckey]
-                        os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-                        self.logger.debug("Package build process terminated for %s", dsckey)
-                        del self.sbuild_processes[user][dsckey]
-                        break
+                with self.tasks_lock:
+                    p = self.sbuild_processes.get(user, {}).pop(done_dsc, None)
+                if p:
+                    self.logger.debug("Terminating package build process for %s", done_dsc)
+                    self._kill_build(p)
+                    self.logger.debug("Package build process terminated for %s", done_dsc)
+                    self._finish_task(done_dsc, p, 'killed')
+                else:
+                    # The reaper has already released the chroot
+                    self.logger.debug("The build of %s has already exited", done_dsc)
+                self.refresh_event.set()
         else:
             if owner in ['sbuild', 'all']:
                 self.chroots_pool.show()
-                if self.sbuild_processes and self.sbuild_processes[user]:
-                    for dsckey in self.sbuild_processes[user].keys():
-                        self.logger.debug("Terminating package build process for %s", dsckey)
-                        p = self.sbuild_processes[user][dsckey]
-                        os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-                        self.logger.debug("chroot:%s ---> %s", self.chroots_state[dsckey], dsckey)
-                        self.chroots_pool.release(self.chroots_state[dsckey])
-                        self.logger.debug("Package build process terminated")
-                    del self.sbuild_processes[user]
+                with self.tasks_lock:
+                    processes = self.sbuild_processes.pop(user, {})
+                for dsckey, p in processes.items():
+                    self.logger.debug("Terminating package build process for %s", dsckey)
+                    self._kill_build(p)
+                    self.logger.debug("chroot:%s ---> %s", self.chroots_state.get(dsckey), dsckey)
+                    self._finish_task(dsckey, p, 'killed')
+                    self.logger.debug("Package build process terminated")
+                if processes:
+                    self.refresh_event.set()
 
         if owner in ['chroot', 'all']:
             if self.ctlog:
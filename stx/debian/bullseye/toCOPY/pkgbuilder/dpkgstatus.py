@@ -0,0 +1,171 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import os
+import subprocess
+import threading
+
+DIGITS = '0123456789'
+DPKG_STATUS = 'var/lib/dpkg/status'
+
+
+def _char_order(version, i):
+    # Same ordering as dpkg: '~' sorts before everything, even the
+    # end of the string, letters sort before the other characters
+    if i >= len(version) or version[i] in DIGITS:
+        return 0
+    c = version[i]
+    if c == '~':
+        return -1
+    if c.isascii() and c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_part(a, b):
+    i = j = 0
+    while i < len(a) or j < len(b):
+        # Compare the non-digit prefixes
+        while (i < len(a) and a[i] not in DIGITS) or (j < len(b) and b[j] not in DIGITS):
+            diff = _char_order(a, i) - _char_order(b, j)
+            if diff:
+                return diff
+            i += 1
+            j += 1
+        # Compare the numbers
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        first_diff = 0
+        while i < len(a) and a[i] in DIGITS and j < len(b) and b[j] in DIGITS:
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i] in DIGITS:
+            return 1
+        if j < len(b) and b[j] in DIGITS:
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def split_version(version):
+    """Split a Debian version into (epoch, upstream version, revision)"""
+    epoch = 0
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        epoch = int(epoch)
+    revision = ''
+    if '-' in version:
+        version, revision = version.rsplit('-', 1)
+    return epoch, version, revision
+
+
+def version_compare(a, b):
+    """
+    Compare two Debian versions like 'dpkg --compare-versions',
+    returns a negative number, zero or a positive number when
+    a is older than, equal to or newer than b
+    """
+    epoch_a, upstream_a, revision_a = split_version(a)
+    epoch_b, upstream_b, revision_b = split_version(b)
+    if epoch_a != epoch_b:
+        return epoch_a - epoch_b
+    return _compare_part(upstream_a, upstream_b) or _compare_part(revision_a, revision_b)
+
+
+def get_deb_fields(deb_path):
+    """The (Package, Version) of a .deb file"""
+    output = subprocess.check_output(['dpkg-deb', '--show', '--showformat',
+                                      '${Package} ${Version}', deb_path])
+    name, version = output.decode().split()
+    return name, version
+
+
+class DpkgStatusIndex(object):
+    """
+    The packages installed in a chroot as recorded by its dpkg status
+    file: name -> (version, arch). The file is parsed again
+    only when its mtime or size changes.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.status_path = None
+        self.signature = None
+        self.packages = {}
+        self.lock = threading.Lock()
+
+    def load(self, chroot_dir):
+        with self.lock:
+            status_path = os.path.join(chroot_dir, DPKG_STATUS)
+            if status_path != self.status_path:
+                self.status_path = status_path
+                self.signature = None
+            self._refresh()
+
+    def _refresh(self):
+        if not self.status_path:
+            return
+        try:
+            st = os.stat(self.status_path)
+        except OSError:
+            self.signature = None
+            self.packages = {}
+            return
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if signature == self.signature:
+            return
+        packages = {}
+        with open(self.status_path) as f:
+            for stanza in f.read().split('\n\n'):
+                fields = self._parse_stanza(stanza)
+                if not fields.get('Status', '').endswith(' installed'):
+                    continue
+                packages[fields['Package']] = (fields.get('Version', ''),
+                                               fields.get('Architecture', ''))
+        self.signature = signature
+        self.packages = packages
+        self.logger.info("Parent chroot has %d installed packages", len(packages))
+
+    def _parse_stanza(self, stanza):
+        fields = {}
+        for line in stanza.splitlines():
+            # Skip the continuation lines of the multiline fields
+            if not line or line[0] in ' \t':
+                continue
+            key, sep, value = line.partition(':')
+            if sep and key in ('Package', 'Status', 'Version', 'Architecture'):
+                fields[key] = value.strip()
+        return fields
+
+    def __len__(self):
+        return len(self.packages)
+
+    def get(self, name):
+        return self.packages.get(name)
+
+    def needs_upgrade(self, name, version=None):
+        """
+        Whether the installed package is older than the given version,
+        any installed package needs the upgrade if the version is unknown
+        """
+        entry = self.packages.get(name)
+        if not entry:
+            return False
+        if not version:
+            return True
+        return version_compare(version, entry[0]) > 0
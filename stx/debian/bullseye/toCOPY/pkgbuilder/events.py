@@ -0,0 +1,123 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import collections
+import json
+import threading
+import time
+
+# Events kept for the clients catching up with 'since'
+MAX_EVENTS = 4096
+# Clients waiting for new events at once (long-polls and streams), each
+# of them holds a server thread
+MAX_WAITERS = 4
+# Longest wait of a long-poll in seconds
+MAX_WAIT = 30
+# Seconds after which a stream ends, the client reconnects with the
+# Last-Event-ID header and resumes where it stopped
+STREAM_DURATION = 300
+# Milliseconds the clients wait before reconnecting to a stream
+STREAM_RETRY = 3000
+
+
+class EventBus(object):
+    """
+    Chroot and task state changes numbered in the order they happen,
+    the clients wait for the events after the last sequence number
+    they have seen (long-poll) or get them streamed (server-sent events)
+    """
+    def __init__(self):
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.seq = 0
+        self.waiters = 0
+        self.cond = threading.Condition()
+
+    def publish(self, event_type, **data):
+        with self.cond:
+            self.seq += 1
+            self.events.append({'seq': self.seq, 'time': time.time(),
+                                'type': event_type, 'data': data})
+            self.cond.notify_all()
+
+    def get_events(self, since=0):
+        with self.cond:
+            # A sequence number from before a restart of the service
+            if since > self.seq:
+                since = 0
+            return [event for event in self.events if event['seq'] > since]
+
+    def add_waiter(self):
+        with self.cond:
+            if self.waiters >= MAX_WAITERS:
+                return False
+            self.waiters += 1
+            return True
+
+    def remove_waiter(self):
+        with self.cond:
+            self.waiters -= 1
+
+    def _wait(self, since, timeout):
+        with self.cond:
+            if since > self.seq:
+                since = 0
+            self.cond.wait_for(lambda: self.seq > since, timeout)
+            return self.get_events(since)
+
+    def wait(self, since=0, timeout=MAX_WAIT):
+        """
+        The events after 'since', waits up to timeout for new ones unless
+        too many clients are waiting already
+        """
+        if not self.add_waiter():
+            return self.get_events(since)
+        try:
+            return self._wait(since, min(timeout, MAX_WAIT))
+        finally:
+            self.remove_waiter()
+
+    def get_seq(self):
+        with self.cond:
+            return self.seq
+
+    def stream(self, since=0, keepalive=15, duration=STREAM_DURATION):
+        """
+        Generate the events in the server-sent events format for up to
+        duration seconds, the stream ends at once if too many clients
+        are waiting already
+        """
+        yield 'retry: %d\n\n' % STREAM_RETRY
+        if not self.add_waiter():
+            yield ': too many clients waiting for events\n\n'
+            return
+        try:
+            deadline = time.time() + duration
+            while time.time() < deadline:
+                events = self._wait(since, min(keepalive, deadline - time.time()))
+                if not events:
+                    yield ': keepalive\n\n'
+                    continue
+                for event in events:
+                    yield 'id: %d\nevent: %s\ndata: %s\n\n' % (
+                        event['seq'], event['type'], json.dumps(event))
+                since = events[-1]['seq']
+        finally:
+            self.remove_waiter()
+
+
+event_bus = EventBus()
+
+
+def publish(event_type, **data):
+    event_bus.publish(event_type, **data)
@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import collections
+import concurrent.futures
+import threading
+import time
+import uuid
+
+# Finished jobs kept for the queries of their results
+MAX_FINISHED_JOBS = 256
+
+current = threading.local()
+
+
+def report_progress(done, total, msg=''):
+    """Update the progress of the job running in this thread, if any"""
+    job = getattr(current, 'job', None)
+    if job:
+        job.progress = {'done': done, 'total': total, 'msg': msg}
+
+
+class Job(object):
+    def __init__(self, action, args):
+        self.job_id = uuid.uuid4().hex
+        self.action = action
+        self.args = args
+        self.state = 'queued'
+        self.progress = None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {'id': self.job_id,
+                'action': self.action,
+                'args': self.args,
+                'state': self.state,
+                'progress': self.progress,
+                'result': self.result,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished}
+
+
+class JobManager(object):
+    """
+    Run the long pkgbuilder requests in the background: the request
+    gets the job id at once and polls the job for the progress and
+    the result, which is the response of the synchronous request
+    """
+    def __init__(self, logger, max_workers=4):
+        self.logger = logger
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='job')
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.lock = threading.Lock()
+
+    def submit(self, action, func, args):
+        job = Job(action, args)
+        with self.lock:
+            self.jobs[job.job_id] = job
+        self.executor.submit(self.run, job, func)
+        self.logger.info('Submitted job %s: %s', job.job_id, action)
+        return job
+
+    def run(self, job, func):
+        job.state = 'running'
+        job.started = time.time()
+        current.job = job
+        try:
+            job.result = func(job.args)
+            job.state = 'done'
+        except Exception as e:
+            self.logger.exception('Job %s (%s) failed', job.job_id, job.action)
+            job.result = {'status': 'error', 'msg': str(e)}
+            job.state = 'failed'
+        finally:
+            current.job = None
+            job.finished = time.time()
+            self.logger.info('Job %s (%s) %s in %.1fs', job.job_id, job.action,
+                             job.state, job.finished - job.started)
+            self.retire(job)
+
+    def retire(self, job):
+        with self.lock:
+            self.finished.append(job.job_id)
+            while len(self.finished) > MAX_FINISHED_JOBS:
+                self.jobs.pop(self.finished.popleft(), None)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        with self.lock:
+            return [job.to_dict() for job in sorted(self.jobs.values(),
+                                                    key=lambda job: job.submitted)]
@@ -0,0 +1,144 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import bisect
+import threading
+
+# Buckets in seconds of the operations on chroots and builds
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+# Buckets in seconds of the waits for locks and chroots
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+
+def format_labels(labelnames, labelvalues, extra=''):
+    labels = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+              for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels -> [bucket counts..., +Inf count, sum, count]
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 3)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labelnames, key, 'le="%s"' % format_value(bound)),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labelnames, key),
+                                          format_value(values[-2])))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labelnames, key),
+                                            values[-1]))
+        return lines
+
+
+class Gauge(object):
+    """A gauge read at collection time from a function returning {labels: value}"""
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def collect(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s gauge' % self.name]
+        if self.func:
+            for key, value in sorted(self.func().items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labelnames, key),
+                                          format_value(value)))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=(), func=None):
+        return self.register(Gauge(name, documentation, labelnames, func))
+
+    def exposition(self):
+        """All the metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+CLONE_SECONDS = registry.histogram(
+    'pkgbuilder_clone_seconds', 'Time to clone a chroot from the parent chroot',
+    ['backend', 'status'])
+REFRESH_SECONDS = registry.histogram(
+    'pkgbuilder_refresh_seconds', 'Time to refresh a chroot from the parent chroot',
+    ['status'])
+PARENT_UPGRADE_SECONDS = registry.histogram(
+    'pkgbuilder_parent_upgrade_seconds', 'Time of a batched upgrade of the parent chroot',
+    ['status'])
+SBUILD_SECONDS = registry.histogram(
+    'pkgbuilder_sbuild_seconds', 'Duration of the sbuild runs',
+    ['state', 'result'])
+ACQUIRE_WAIT_SECONDS = registry.histogram(
+    'pkgbuilder_acquire_wait_seconds', 'Time the build tasks waited for a chroot',
+    ['result'], WAIT_BUCKETS)
+PARENT_LOCK_WAIT_SECONDS = registry.histogram(
+    'pkgbuilder_parent_lock_wait_seconds', 'Time waited for the parent chroot lock',
+    ['mode'], WAIT_BUCKETS)
+PARENT_LOCK_HOLD_SECONDS = registry.histogram(
+    'pkgbuilder_parent_lock_hold_seconds', 'Time the parent chroot lock was held',
+    ['mode'], WAIT_BUCKETS)
@@ -0,0 +1,157 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import copy
+import json
+import os
+import psutil
+import threading
+
+# Bytes read from the end of a build log for its status
+LOG_TAIL_SIZE = 65536
+
+
+def get_dev(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class PoolState(object):
+    """
+    The state of the chroots pool and the running builds, written to
+    disk after every change so that a restarted service takes over the
+    builds still running and keeps the clean chroots clean instead of
+    refreshing them all. The changes are written by a background thread,
+    several changes in a row in one write, so that the pool never waits
+    for the disk. The file is replaced atomically, a crash leaves either
+    a previous or the latest state
+    """
+    def __init__(self, state_file, logger):
+        self.state_file = state_file
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.state = {'owner': None, 'chroots': {}, 'tasks': {}}
+        self.changed = threading.Event()
+        self.load()
+        self.writer = threading.Thread(target=self.write_changes,
+                                       name='pool-state-writer', daemon=True)
+        self.writer.start()
+
+    def load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning("Failed to load the pool state %s: %s", self.state_file, e)
+            return
+        for key in self.state:
+            if key in state:
+                self.state[key] = state[key]
+
+    def write_changes(self):
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            self.save()
+
+    def save(self):
+        state = self.get()
+        tmp_file = self.state_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            self.logger.warning("Failed to save the pool state %s: %s", self.state_file, e)
+
+    def get(self):
+        '''
+        The current state, with the device of each chroot directory to
+        tell if it is still on the same mount
+        '''
+        with self.lock:
+            state = copy.deepcopy(self.state)
+        for chroot in state['chroots'].values():
+            if 'path' in chroot:
+                chroot['dev'] = get_dev(chroot.pop('path'))
+        return state
+
+    def update(self, key, value):
+        with self.lock:
+            if self.state[key] == value:
+                return
+            self.state[key] = value
+        self.changed.set()
+
+    def set_owner(self, owner):
+        self.update('owner', list(owner) if owner else None)
+
+    def set_chroots(self, chroots):
+        '''chroots: {name: {'state', 'dirty', 'path' or 'dev'}} of the pool'''
+        self.update('chroots', chroots)
+
+    def set_tasks(self, tasks):
+        '''tasks: {dsc: {'user', 'chroot', 'pid', 'create_time', ...}} of the running builds'''
+        self.update('tasks', tasks)
+
+
+def get_create_time(pid):
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.Error:
+        return None
+
+
+class AdoptedProcess(object):
+    """
+    A build started by a previous instance of the service, it stands for
+    the Popen object of the build. This service is not its parent so its
+    exit status is taken from the status sbuild writes in the build log
+    """
+    def __init__(self, pid, create_time, build_log=None):
+        self.pid = pid
+        self.create_time = create_time
+        self.build_log = build_log
+        self.returncode = None
+
+    def is_alive(self):
+        # The pid may have been reused since the state was saved
+        try:
+            process = psutil.Process(self.pid)
+            return process.create_time() == self.create_time and \
+                process.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    def get_log_status(self):
+        try:
+            with open(self.build_log, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - LOG_TAIL_SIZE))
+                tail = f.read().decode(errors='replace')
+        except (OSError, TypeError):
+            return 1
+        return 0 if '\nStatus: successful' in tail else 1
+
+    def poll(self):
+        if self.returncode is None and not self.is_alive():
+            self.returncode = self.get_log_status()
+        return self.returncode
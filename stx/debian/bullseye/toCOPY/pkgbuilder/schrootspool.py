@@ -12,13 +12,21 @@
 #
 # Copyright (C) 2022 Wind River Systems,Inc
 #
+import bisect
+import chrootclone
+import configparser
+import events
 import logging
+import metrics
 import os
 import re
-import subprocess
-import utils
+import threading
+import time
 
 SCHROOTS_CONFIG = '/etc/schroot/chroot.d/'
+SCHROOT_SESSIONS = '/var/lib/schroot/session'
+# Seconds after which the free space of the idle schroots is sampled again
+SIZE_UPDATE_INTERVAL = 30
 
 
 def bytes_to_human_readable(size):
@@ -76,37 +84,178 @@ def human_readable_to_bytes(human_size):
     return value
 
 
+def get_tmpfs_mounts():
+    tmpfs_mounts = set()
+    with open('/proc/self/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3 and fields[2] == 'tmpfs':
+                tmpfs_mounts.add(fields[1])
+    return tmpfs_mounts
+
+
+def is_tmpfs_chroot(directory, tmpfs_mounts):
+    # Overlay clones keep their writable layer in a side directory
+    return directory in tmpfs_mounts or \
+        (directory + chrootclone.OVERLAY_SUFFIX) in tmpfs_mounts
+
+
+def get_free_size(path):
+    if not path or not os.path.exists(path):
+        return 0
+    statvfs = os.statvfs(path)
+    return statvfs.f_frsize * statvfs.f_bavail
+
+
+class SchrootConfigIndex(object):
+    """
+    In-process index of the schroot config files, it replaces forking
+    'schroot --list', 'schroot --config' and 'grep' per query.
+    The files are parsed again only when the directory or one of its
+    files has been modified since the last scan.
+    """
+    def __init__(self, config_dir=SCHROOTS_CONFIG):
+        self.config_dir = config_dir
+        self.signature = None
+        self.chroots = {}
+        self.lock = threading.Lock()
+
+    def get_signature(self):
+        try:
+            signature = [os.stat(self.config_dir).st_mtime_ns]
+            with os.scandir(self.config_dir) as entries:
+                for entry in entries:
+                    signature.append((entry.name, entry.stat().st_mtime_ns))
+        except OSError:
+            return None
+        return tuple(sorted(signature, key=str))
+
+    def scan(self):
+        chroots = {}
+        if not os.path.isdir(self.config_dir):
+            return chroots
+        for conf_name in sorted(os.listdir(self.config_dir)):
+            # Like schroot, ignore the files run-parts would not run
+            if not re.match(r'^[\w-]+$', conf_name):
+                continue
+            conf_path = os.path.join(self.config_dir, conf_name)
+            if not os.path.isfile(conf_path):
+                continue
+            parser = configparser.ConfigParser(interpolation=None, strict=False,
+                                               delimiters=('=',))
+            try:
+                parser.read(conf_path)
+            except configparser.Error:
+                continue
+            for name in parser.sections():
+                directory = parser.get(name, 'directory', fallback='').strip()
+                chroots[name] = {'directory': directory, 'conf_path': conf_path}
+        return chroots
+
+    def refresh(self):
+        with self.lock:
+            signature = self.get_signature()
+            if signature is None or signature != self.signature:
+                self.chroots = self.scan()
+                self.signature = signature
+            return self.chroots
+
+    def names(self):
+        return sorted(self.refresh().keys())
+
+    def get(self, name):
+        return self.refresh().get(name)
+
+
+schroot_config_index = SchrootConfigIndex()
+
+
 def get_schroot_conf_path(name):
     # Get path to schroot config file
-    schroot_config_lines = subprocess.run(['grep', '-r', '-l', '^[[]' + name + '[]]$', SCHROOTS_CONFIG],
-                                          stdout=subprocess.PIPE,
-                                          universal_newlines=True).stdout.splitlines()
-    for line in schroot_config_lines:
-        return line.strip()
+    info = schroot_config_index.get(name)
+    if info:
+        return info['conf_path']
     return None
 
 
+def get_schroot_sessions(session_dir=SCHROOT_SESSIONS):
+    """
+    Read the metadata of all the schroot sessions in one pass over the
+    session directory instead of 'schroot --config' per session.
+    Returns a list of (session, original chroot name, mount location)
+    where session is in the 'session:<id>' form schroot accepts.
+    """
+    sessions = []
+    if not os.path.isdir(session_dir):
+        return sessions
+    for session_file in os.listdir(session_dir):
+        parser = configparser.ConfigParser(interpolation=None, strict=False,
+                                           delimiters=('=',))
+        try:
+            parser.read(os.path.join(session_dir, session_file))
+        except configparser.Error:
+            continue
+        for session_id in parser.sections():
+            original_name = parser.get(session_id, 'original-name', fallback='').strip()
+            mount_location = parser.get(session_id, 'mount-location', fallback='').strip()
+            sessions.append(('session:' + session_id, original_name, mount_location or None))
+    return sessions
+
+
 class Schroot(object):
-    def __init__(self, name, state='idle'):
+    def __init__(self, name, state='idle', dirty=True, tmpfs_mounts=None):
+        '''tmpfs_mounts: the tmpfs mount points, read if not given'''
         self.name = name
         self.state = state
+        # A dirty schroot has been used by a build since its last refresh
+        self.dirty = dirty
         self.size = 0
         self.tmpfs = False
-
-        self.path = self.get_chroot_dir()
+        # (bucket, entry) of the schroot in the free list while it is idle
+        self.free_entry = None
+        # Space reserved for the build running in the schroot, and the
+        # part of it the build is estimated to have written so far
+        self.reserved = 0
+        self.used = 0
+        self.fs_id = None
+
+        info = schroot_config_index.get(name)
+        self.path = info['directory'] if info else ''
         if self.path:
-            statvfs = os.statvfs(self.path)
-            self.size = statvfs.f_frsize * statvfs.f_bavail
-            self.tmpfs = utils.is_tmpfs(self.path)
+            # The clones may have been mounted again with another tmpfs
+            # and disk split since their config files were written
+            if tmpfs_mounts is None:
+                tmpfs_mounts = get_tmpfs_mounts()
+            self.tmpfs = is_tmpfs_chroot(self.path, tmpfs_mounts)
+            self.update_size()
+
+    def get_space_path(self):
+        # The writable layer of an overlay clone is where its space goes
+        layer_dir = self.path + chrootclone.OVERLAY_SUFFIX
+        if os.path.isdir(layer_dir):
+            return layer_dir
+        return self.path
+
+    def update_size(self):
+        space_path = self.get_space_path()
+        try:
+            self.fs_id = os.stat(space_path).st_dev
+        except OSError:
+            self.fs_id = None
+        self.size = get_free_size(space_path)
+
+    def get_dev(self):
+        # A clone on a tmpfs or overlay mount gets a new device once mounted again
+        try:
+            return os.stat(self.path).st_dev
+        except OSError:
+            return None
 
     def get_chroot_dir(self):
         # Get path to chroot
-        schroot_config_lines = subprocess.run(['schroot', '--config', '--chroot', self.name],
-                                              stdout=subprocess.PIPE,
-                                              universal_newlines=True).stdout.splitlines()
-        for line in schroot_config_lines:
-            if line.startswith('directory='):
-                return line.split('=')[1].strip()
+        info = schroot_config_index.get(self.name)
+        if info:
+            return info['directory']
         return ''
 
     def is_idle(self):
@@ -117,12 +266,18 @@ class Schroot(object):
     def set_busy(self):
         self.state = 'work'
 
+    def is_dirty(self):
+        return self.dirty
+
     def get_name(self):
         return self.name
 
     def get_size(self):
         return self.size
 
+    def get_fs_id(self):
+        return self.fs_id
+
     def get_path(self):
         return self.path
 
@@ -133,30 +288,107 @@ class Schroot(object):
         return self.tmpfs
 
 
+class SchrootFreeList(object):
+    """
+    The idle schroots, kept sorted by size in one bucket per
+    (tmpfs, dirty) pair so that the best fitting schroot for
+    a build is found with a binary search
+    """
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, schroot):
+        bucket_key = (schroot.is_tmpfs(), schroot.is_dirty())
+        entry = (schroot.get_size(), schroot.get_name())
+        bisect.insort(self.buckets.setdefault(bucket_key, []), entry)
+        schroot.free_entry = (bucket_key, entry)
+
+    def remove(self, schroot):
+        if schroot.free_entry is None:
+            return
+        bucket_key, entry = schroot.free_entry
+        bucket = self.buckets[bucket_key]
+        index = bisect.bisect_left(bucket, entry)
+        if index < len(bucket) and bucket[index] == entry:
+            del bucket[index]
+        schroot.free_entry = None
+
+    def fits(self, needed_size, tmpfs, dirty):
+        '''The (size, name) entries not smaller than needed_size, smallest first'''
+        bucket = self.buckets.get((tmpfs, dirty), [])
+        for index in range(bisect.bisect_left(bucket, (needed_size, '')), len(bucket)):
+            yield bucket[index]
+
+    def clear(self):
+        self.buckets = {}
+
+
+class SchrootWaiter(object):
+    """
+    A blocked acquire request. Waiters are served by decreasing
+    priority, first come first served within the same priority.
+    """
+    sequence = 0
+
+    def __init__(self, needed_size, allow_tmpfs, priority=0, owner=None):
+        self.needed_size = needed_size
+        self.allow_tmpfs = allow_tmpfs
+        self.priority = priority
+        self.owner = owner
+        self.since = time.time()
+        self.schroot = None
+        SchrootWaiter.sequence += 1
+        self.order = (-priority, SchrootWaiter.sequence)
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+    def to_dict(self):
+        return {'owner': self.owner, 'priority': self.priority,
+                'size': bytes_to_human_readable(self.needed_size),
+                'allow_tmpfs': self.allow_tmpfs,
+                'waited': round(time.time() - self.since, 1)}
+
+
 class SchrootsPool(object):
     """
     schrootsPool manages all the schroots in current container
-    The schroots listed by schroot --list will be registered
+    The schroots configured in chroot.d will be registered
     and assigned the build task
+
+    All the state changes happen under self.lock. When no schroot fits,
+    acquire can block until one is handed over by release: schroots
+    returned to the pool are given to the queued waiters by priority,
+    skipping the waiters they are not big enough for.
     """
     def __init__(self, logger):
         self.schroots = []
+        self.schroots_by_name = {}
+        self.free_list = SchrootFreeList()
+        self.waiters = []
+        # Last free space sampled per filesystem
+        self.fs_free = {}
+        # Part of the reservations not written yet per filesystem
+        self.fs_unused = {}
+        self.sizes_updated = 0
         self.logger = logger
+        self.lock = threading.RLock()
+        self.handover = threading.Condition(self.lock)
+        # Called with the states of the schroots whenever they change
+        self.on_change = None
+        metrics.registry.gauge('pkgbuilder_chroots', 'Chroots in the pool',
+                               ['state', 'tmpfs', 'dirty'], self.get_occupancy)
+        metrics.registry.gauge('pkgbuilder_waiting_tasks', 'Build tasks waiting for a chroot',
+                               func=lambda: {(): self.get_queue_length()})
 
     def exists(self, name):
-        for schroot in self.schroots:
-            if schroot.name == name:
-                return True
-        return False
+        return name in self.schroots_by_name
+
+    def get_schroot(self, name):
+        return self.schroots_by_name.get(name.strip())
 
     def get_schroot_list(self):
-        schroot_list = []
-        for line in subprocess.run(['schroot', '--list'], stdout=subprocess.PIPE,
-                                   universal_newlines=True).stdout.splitlines():
-            parts = line.split(':')
-            if len(parts) >= 2:
-                schroot_list.append(parts[1].strip())
-        return schroot_list
+        return schroot_config_index.names()
 
     def get_schroot_clone_list(self):
         schroot_clone_list = []
@@ -175,86 +407,341 @@ class SchrootsPool(object):
         self.logger.error('parent schroot not found')
         raise ValueError('parent schroot not found')
 
-    def load(self):
-        self.schroots = []
-        schroots = self.get_schroot_clone_list()
-        if len(schroots) < 1:
-            self.logger.error('There are no schroots found, exit')
-            return False
-        for name in schroots:
-            if not self.exists(name):
-                self.schroots.append(Schroot(name, 'idle'))
-        return True
-
-    def acquire(self, needed_size=1, allow_tmpfs=True):
+    def set_idle(self, schroot, dirty):
+        self.free_list.remove(schroot)
+        # What the build wrote since the last sample is its own
+        schroot.update_size()
+        self.account_usage(schroot.get_fs_id(), schroot.get_size())
+        self.unreserve(schroot)
+        schroot.state = 'idle'
+        schroot.dirty = dirty
+        self.free_list.add(schroot)
+        self.notify_change()
+        self.serve_waiters()
+
+    def take(self, schroot, state):
+        self.free_list.remove(schroot)
+        schroot.state = state
+        self.notify_change()
+
+    def get_states(self):
+        '''The states of the schroots, cheap enough to take on every change'''
+        with self.lock:
+            return {schroot.name: {'state': schroot.state, 'dirty': schroot.dirty,
+                                   'path': schroot.path}
+                    for schroot in self.schroots}
+
+    def notify_change(self):
+        if self.on_change:
+            self.on_change(self.get_states())
+
+    def account_usage(self, fs_id, free):
+        '''
+        Take a new sample of the free space of a filesystem: the space
+        consumed since the last sample is counted as written by the builds
+        running on it, in proportion to the part of their reservation
+        they have not used yet
+        '''
+        last_free = self.fs_free.get(fs_id)
+        self.fs_free[fs_id] = free
+        if last_free is None or free >= last_free:
+            return
+        running = [schroot for schroot in self.schroots
+                   if schroot.reserved > schroot.used and schroot.get_fs_id() == fs_id]
+        unused = sum(schroot.reserved - schroot.used for schroot in running)
+        consumed = min(last_free - free, unused)
+        for schroot in running:
+            written = consumed * (schroot.reserved - schroot.used) // unused
+            schroot.used += written
+            self.fs_unused[fs_id] -= written
+
+    def reserve(self, schroot, size):
+        # Start accounting from the free space right before the build
+        self.account_usage(schroot.get_fs_id(), get_free_size(schroot.get_space_path()))
+        schroot.reserved = size
+        schroot.used = 0
+        fs_id = schroot.get_fs_id()
+        self.fs_unused[fs_id] = self.fs_unused.get(fs_id, 0) + size
+
+    def unreserve(self, schroot):
+        if schroot.reserved:
+            fs_id = schroot.get_fs_id()
+            self.fs_unused[fs_id] -= schroot.reserved - schroot.used
+        schroot.reserved = 0
+        schroot.used = 0
+
+    def get_available_size(self, schroot):
+        '''Free space of the schroot minus the part of the reservations of
+        the running builds on the same filesystem they have not written yet,
+        the written part is already missing from the free space'''
+        fs_id = schroot.get_fs_id()
+        return self.fs_free.get(fs_id, schroot.get_size()) - self.fs_unused.get(fs_id, 0)
+
+    def update_sizes(self, force=False):
+        '''Sample the free space of the idle schroots and of the filesystems
+        of the running builds again'''
+        with self.lock:
+            if not force and time.time() - self.sizes_updated < SIZE_UPDATE_INTERVAL:
+                return
+            sampled = set()
+            for schroot in self.schroots:
+                if schroot.is_idle():
+                    self.free_list.remove(schroot)
+                    schroot.update_size()
+                    self.free_list.add(schroot)
+                    self.account_usage(schroot.get_fs_id(), schroot.get_size())
+                    sampled.add(schroot.get_fs_id())
+            for schroot in self.schroots:
+                if schroot.reserved and schroot.get_fs_id() not in sampled:
+                    self.account_usage(schroot.get_fs_id(),
+                                       get_free_size(schroot.get_space_path()))
+                    sampled.add(schroot.get_fs_id())
+            self.sizes_updated = time.time()
+
+    def load(self, dirty=True, saved_states=None):
+        '''
+        dirty: whether the loaded schroots need a refresh before use,
+        freshly cloned schroots do not
+        saved_states: states saved before, see PoolState. The busy
+        schroots are kept busy, the idle ones keep their dirty flag if
+        they are still on the same mount
+        '''
+        saved_states = saved_states or {}
+        with self.lock:
+            self.schroots = []
+            self.schroots_by_name = {}
+            self.free_list.clear()
+            self.fs_free = {}
+            self.fs_unused = {}
+            self.sizes_updated = time.time()
+            schroots = self.get_schroot_clone_list()
+            if len(schroots) < 1:
+                self.logger.error('There are no schroots found, exit')
+                return False
+            tmpfs_mounts = get_tmpfs_mounts()
+            for name in schroots:
+                if not self.exists(name):
+                    schroot = Schroot(name, 'idle', dirty, tmpfs_mounts)
+                    saved = saved_states.get(name)
+                    if saved and saved['state'] != 'idle':
+                        schroot.state = saved['state']
+                        schroot.dirty = True
+                    elif saved and saved['dev'] == schroot.get_dev():
+                        schroot.dirty = saved['dirty']
+                    self.schroots.append(schroot)
+                    self.schroots_by_name[name] = schroot
+                    if schroot.is_idle():
+                        self.free_list.add(schroot)
+            self.notify_change()
+            self.serve_waiters()
+            return True
+
+    def take_best_fit(self, needed_size_bytes, allow_tmpfs):
+        '''
+        Assign the smallest idle schroot which is big enough (best fit),
+        a tmpfs one wins a tie. Clean schroots are preferred, a dirty one
+        is only assigned when no clean one fits and must be refreshed
+        by the caller
+        '''
+        self.update_sizes()
+        tmpfs_choices = (True, False) if allow_tmpfs else (False,)
+        # Filesystems committed to other builds, their schroots are skipped
+        full_fs = set()
+        for dirty in (False, True):
+            best = None
+            for tmpfs in tmpfs_choices:
+                for size, name in self.free_list.fits(needed_size_bytes, tmpfs, dirty):
+                    schroot = self.schroots_by_name[name]
+                    if schroot.get_fs_id() in full_fs:
+                        continue
+                    if self.get_available_size(schroot) < needed_size_bytes:
+                        full_fs.add(schroot.get_fs_id())
+                        continue
+                    if best is None or size < best[0]:
+                        best = (size, name)
+                    break
+            if best:
+                schroot = self.schroots_by_name[best[1]]
+                self.take(schroot, 'work')
+                self.reserve(schroot, needed_size_bytes)
+                self.logger.debug('%s has been assigned, %s reserved', schroot.name,
+                                  bytes_to_human_readable(needed_size_bytes))
+                events.publish('chroot_acquired', name=schroot.name, dirty=schroot.dirty,
+                               reserved=needed_size_bytes)
+                return schroot.name
+        return None
+
+    def serve_waiters(self):
+        '''Hand the idle schroots over to the waiters they fit, in order.'''
+        with self.lock:
+            served = False
+            for waiter in list(self.waiters):
+                waiter.schroot = self.take_best_fit(waiter.needed_size, waiter.allow_tmpfs)
+                if waiter.schroot:
+                    self.waiters.remove(waiter)
+                    served = True
+            if served:
+                self.handover.notify_all()
+
+    def acquire(self, needed_size=1, allow_tmpfs=True, timeout=0, priority=0, owner=None):
+        '''
+        Assign an idle schroot, see take_best_fit. If none fits, wait up
+        to timeout seconds in the queue for one to be released, the
+        waiters with a higher priority are served first.
+        Idle schroots are always handed to the waiters first, so an idle
+        schroot which fits is never held back for a queued request.
+        '''
         self.logger.debug("schroot pool status:")
         self.show()
         needed_size_bytes = human_readable_to_bytes(needed_size)
-        if allow_tmpfs:
-            # tmpfs is allowed. Try to find an idle tmpfs build environment.
+        with self.lock:
+            name = self.take_best_fit(needed_size_bytes, allow_tmpfs)
+            if name or timeout <= 0:
+                if not name:
+                    self.logger.debug("No idle schroot can be used")
+                metrics.ACQUIRE_WAIT_SECONDS.observe(0, result='acquired' if name else 'none')
+                return name
+
+            waiter = SchrootWaiter(needed_size_bytes, allow_tmpfs, priority, owner)
+            bisect.insort(self.waiters, waiter)
+            self.logger.debug("No idle schroot can be used, queued at position %d",
+                              self.waiters.index(waiter) + 1)
+            deadline = time.time() + timeout
+            while waiter.schroot is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiters.remove(waiter)
+                    self.logger.debug("Timed out after %ds waiting for a schroot", timeout)
+                    metrics.ACQUIRE_WAIT_SECONDS.observe(time.time() - waiter.since,
+                                                         result='timeout')
+                    return None
+                self.handover.wait(remaining)
+            self.logger.debug("%s has been handed over after %.1fs", waiter.schroot,
+                              time.time() - waiter.since)
+            metrics.ACQUIRE_WAIT_SECONDS.observe(time.time() - waiter.since, result='acquired')
+            return waiter.schroot
+
+    def get_occupancy(self):
+        '''Number of schroots by (state, tmpfs, dirty)'''
+        occupancy = {}
+        with self.lock:
             for schroot in self.schroots:
-                if schroot.is_idle() and schroot.is_tmpfs() and (needed_size_bytes <= schroot.get_size()):
-                    schroot.set_busy()
-                    self.logger.debug('%s has been assigned', schroot.name)
-                    return schroot.name
+                key = (schroot.state, str(schroot.tmpfs).lower(), str(schroot.dirty).lower())
+                occupancy[key] = occupancy.get(key, 0) + 1
+        return occupancy
 
-        # Find any suitable build environment that is idle
-        for schroot in self.schroots:
-            if schroot.is_idle() and (needed_size_bytes <= schroot.get_size()):
-                if allow_tmpfs or not schroot.is_tmpfs():
-                    schroot.set_busy()
-                    self.logger.debug('%s has been assigned', schroot.name)
-                    return schroot.name
-        self.logger.debug("No idle schroot can be used")
-        self.show()
-        return None
+    def get_queue_length(self):
+        with self.lock:
+            return len(self.waiters)
+
+    def get_queue(self):
+        with self.lock:
+            return [waiter.to_dict() for waiter in self.waiters]
 
     def release(self, name):
-        for schroot in self.schroots:
-            if schroot.name == name.strip():
+        with self.lock:
+            schroot = self.get_schroot(name)
+            if schroot:
                 # Fixme, whether need to end session here
-                schroot.state = 'idle'
+                self.set_idle(schroot, True)
                 self.logger.debug('%s has been released', name)
+                events.publish('chroot_released', name=name)
+
+    def is_dirty(self, name):
+        schroot = self.get_schroot(name)
+        if schroot:
+            return schroot.is_dirty()
+        return False
+
+    def claim_refresh(self, name):
+        '''
+        Take an idle schroot out of the pool for refreshing,
+        returns False if it is not idle
+        '''
+        with self.lock:
+            schroot = self.get_schroot(name)
+            if schroot and schroot.is_idle():
+                self.take(schroot, 'refresh')
+                return True
+        return False
+
+    def claim_dirty(self, exclude=()):
+        '''
+        Take an idle and dirty schroot out of the pool for refreshing
+        '''
+        with self.lock:
+            for schroot in self.schroots:
+                if schroot.is_idle() and schroot.is_dirty() and schroot.name not in exclude:
+                    self.take(schroot, 'refresh')
+                    return schroot.name
+        return None
+
+    def mark_dirty(self):
+        '''Mark the idle schroots dirty, e.g. after the parent has changed'''
+        with self.lock:
+            for schroot in self.schroots:
+                if schroot.is_idle() and not schroot.is_dirty():
+                    self.free_list.remove(schroot)
+                    schroot.dirty = True
+                    self.free_list.add(schroot)
+            self.notify_change()
+
+    def finish_refresh(self, name, refreshed):
+        with self.lock:
+            schroot = self.get_schroot(name)
+            if schroot:
+                self.set_idle(schroot, not refreshed)
+                self.logger.debug('%s is back to the pool, dirty:%s', name, schroot.dirty)
 
     def is_tmpfs(self, name):
-        for schroot in self.schroots:
-            if schroot.name == name.strip():
-                # Fixme, whether need to end session here
-                return schroot.is_tmpfs()
+        schroot = self.get_schroot(name)
+        if schroot:
+            return schroot.is_tmpfs()
         return False
 
     def get_busy(self):
         busy_schroots = []
-        for schroot in self.schroots:
-            schroot_name = schroot.get_name()
-            if schroot.is_idle():
-                continue
-            busy_schroots.append(schroot_name)
-            self.logger.warning('schroot %s is busy and can not be refreshed', schroot_name)
+        with self.lock:
+            for schroot in self.schroots:
+                schroot_name = schroot.get_name()
+                if schroot.is_idle():
+                    continue
+                busy_schroots.append(schroot_name)
+                self.logger.warning('schroot %s is busy and can not be refreshed', schroot_name)
         return busy_schroots
 
     def get_idle(self):
         idle_schroots = []
-        for schroot in self.schroots:
-            schroot_name = schroot.get_name()
-            if not schroot.is_idle():
-                continue
-            idle_schroots.append(schroot_name)
-            self.logger.debug('schroot %s is idle and can be refreshed', schroot_name)
+        with self.lock:
+            for schroot in self.schroots:
+                schroot_name = schroot.get_name()
+                if not schroot.is_idle():
+                    continue
+                idle_schroots.append(schroot_name)
+                self.logger.debug('schroot %s is idle and can be refreshed', schroot_name)
         return idle_schroots
 
     def release_all(self):
-        for schroot in self.schroots:
-            # Fixme, whether need to end session here
-            schroot.state = 'idle'
+        with self.lock:
+            for schroot in self.schroots:
+                # A refresh in progress gives the schroot back by itself
+                if schroot.state == 'refresh':
+                    continue
+                if schroot.state == 'work':
+                    events.publish('chroot_released', name=schroot.name)
+                # Fixme, whether need to end session here
+                self.set_idle(schroot, True)
         self.logger.debug('All chroots have been released')
 
     def show(self):
-        for schroot in self.schroots:
-            self.logger.info("schroot name:%s state:%s tmpfs:%s size:%s path=%s",
-                             schroot.get_name(), schroot.get_state(),
-                             schroot.is_tmpfs(), bytes_to_human_readable(schroot.get_size()),
-                             schroot.get_path())
+        with self.lock:
+            for schroot in self.schroots:
+                self.logger.info("schroot name:%s state:%s dirty:%s tmpfs:%s size:%s reserved:%s path=%s",
+                                 schroot.get_name(), schroot.get_state(), schroot.is_dirty(),
+                                 schroot.is_tmpfs(), bytes_to_human_readable(schroot.get_size()),
+                                 bytes_to_human_readable(schroot.reserved), schroot.get_path())
+            if self.waiters:
+                self.logger.info("%d request(s) waiting for a schroot", len(self.waiters))
 
 
 if __name__ == "__main__":
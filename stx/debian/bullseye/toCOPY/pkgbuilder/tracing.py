@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+#
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+# Finished spans are also appended as JSON lines to this file if set
+TRACE_FILE = os.environ.get('PKGBUILDER_TRACE_FILE', '')
+# Finished spans kept in memory for the export
+MAX_SPANS = 10000
+
+_local = threading.local()
+_spans = collections.deque(maxlen=MAX_SPANS)
+_lock = threading.Lock()
+
+
+class Span(object):
+    def __init__(self, name, trace_id, parent_id=None, attrs=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = attrs or {}
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.duration = None
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'thread': self.thread,
+                'start': self.start, 'duration': self.duration, 'attrs': self.attrs}
+
+
+def current():
+    """The innermost span of this thread, to continue the trace in another thread"""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def _finish(span):
+    span.duration = time.time() - span.start
+    record = span.to_dict()
+    with _lock:
+        _spans.append(record)
+        if TRACE_FILE:
+            try:
+                with open(TRACE_FILE, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError:
+                pass
+
+
+@contextlib.contextmanager
+def span(name, root=False, parent=None, **attrs):
+    """
+    Record the time spent in the block as a span of the current trace,
+    a new trace is started if root is set and there is no current one.
+    Outside of a trace nothing is recorded
+    """
+    parent = parent or current()
+    if parent:
+        new_span = Span(name, parent.trace_id, parent.span_id, attrs)
+    elif root:
+        new_span = Span(name, uuid.uuid4().hex, None, attrs)
+    else:
+        yield None
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(new_span)
+    try:
+        yield new_span
+    finally:
+        stack.pop()
+        _finish(new_span)
+
+
+def traced(name=None, root=False):
+    """
+    Decorator recording the calls as spans, the trace id of a root span
+    is returned in the 'trace_id' of the response dict
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, root=root) as new_span:
+                result = func(*args, **kwargs)
+                if root and new_span and new_span.parent_id is None and isinstance(result, dict):
+                    result['trace_id'] = new_span.trace_id
+                return result
+        return wrapper
+    return decorator
+
+
+def in_current_trace(func, name=None):
+    """Wrap func to record its calls in another thread as spans of the current trace"""
+    parent = current()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name or func.__name__, parent=parent):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def get_spans(trace_id=None):
+    with _lock:
+        spans = list(_spans)
+    if trace_id:
+        spans = [s for s in spans if s['trace_id'] == trace_id]
+    return spans
+
+
+def to_chrome_trace(spans):
+    """The spans in the Chrome trace event format, for chrome://tracing or Perfetto"""
+    events = []
+    thread_ids = {}
+    for s in spans:
+        if s['thread'] not in thread_ids:
+            thread_ids[s['thread']] = len(thread_ids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                           'tid': thread_ids[s['thread']], 'args': {'name': s['thread']}})
+        args = dict(s['attrs'])
+        args.update(trace_id=s['trace_id'], span_id=s['span_id'], parent_id=s['parent_id'])
+        events.append({'name': s['name'], 'cat': 'pkgbuilder', 'ph': 'X',
+                       'ts': int(s['start'] * 1000000), 'dur': int(s['duration'] * 1000000),
+                       'pid': os.getpid(), 'tid': thread_ids[s['thread']], 'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}